@@ -1,3 +1,5 @@
+import asyncio
+
 from pymongo import ASCENDING, TEXT
 from pymongo.collation import (
     Collation,
@@ -7,6 +9,7 @@ from pymongo.collation import (
 )
 
 from app.app import TypedApp
+from app.models import REDIRECT_INDEX
 from app.routes import bootstrap_routers
 
 
@@ -17,8 +20,9 @@ def initialize_application():
     @app.on_event("startup")
     async def _on_startup():
         await app.database["tinyurl"].create_index(
-            [("tiny_url", ASCENDING), ("url", ASCENDING)], unique=True
+            [("tiny_url", ASCENDING)], unique=True
         )
+        await app.database["tinyurl"].create_index(REDIRECT_INDEX, name="redirect")
         collation = Collation(
             locale="simple",
             alternate=CollationAlternate.NON_IGNORABLE,
@@ -39,5 +43,29 @@ def initialize_application():
         )
         app.producer = app.producer()
         await app.producer.start()
+        # Redirects don't consult the filter until it's built, so startup
+        # doesn't wait for the whole collection to be read.
+        app.url_filter_rebuild = asyncio.create_task(_keep_url_filter_ready())
+
+    async def _keep_url_filter_ready():
+        # Rebuilds the filter whenever it expires or its bitmap is evicted.
+        while True:
+            try:
+                await app.url_filter.rebuild(
+                    app.database["tinyurl"],
+                    "tiny_url",
+                    app.config.url_filter_rebuild_timeout_seconds,
+                )
+            except Exception:
+                app.logger.exception("Failed to rebuild the filter of links.")
+            await asyncio.sleep(app.config.url_filter_check_interval_seconds)
+
+    @app.on_event("shutdown")
+    async def _on_shutdown():
+        app.analytics_executor.shutdown(wait=False, cancel_futures=True)
+        if app.url_filter_rebuild is not None:
+            app.url_filter_rebuild.cancel()
+        await app.producer.stop()
+        await app.connections.close()
 
     return app
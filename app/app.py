@@ -1,37 +1,74 @@
+import asyncio
 import logging
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 
 import aioredis
-from clickhouse_connect import get_client
+from aioredis.client import Script
 from clickhouse_connect.driver import Client
-from aiokafka import AIOKafkaProducer
 from fastapi import FastAPI
 from fastapi.requests import Request
 from motor.core import AgnosticClient, Database
-from motor.motor_asyncio import AsyncIOMotorClient
 
+from app.cache import READ_AND_DECREMENT, BloomFilter, LocalCache, SingleFlight
 from app.config import configuration
+from app.connections import Connections
+from app.messaging import producer_factory
 
 
 class TypedApp(FastAPI):
     logger: logging.Logger
-    db_client: AgnosticClient
-    database: Database
-    redis: aioredis.Redis
-    clickhouse_client: Client
+    connections: Connections
+    analytics_executor: ThreadPoolExecutor
+    local_cache: LocalCache
+    cache_fills: SingleFlight
+    url_filter_rebuild: asyncio.Task | None = None
     config = configuration
 
     def __init__(self, **kwargs) -> None:
         super().__init__(docs_url=None, redoc_url="/docs", **kwargs)
         self.logger = logging.getLogger(self.title)
-        self.db_client = AsyncIOMotorClient(self.config.mongo_dsn)
-        self.database = self.db_client["test"]
-        self.clickhouse_client = get_client(host="clickhouse")
-        self.redis = aioredis.from_url(self.config.redis_dsn)
-        self.producer = partial(
-            AIOKafkaProducer,
-            bootstrap_servers=f"{self.config.kafka_dsn.host}:{self.config.kafka_dsn.port}",
+        self.connections = Connections(self.config)
+        self.analytics_executor = ThreadPoolExecutor(
+            max_workers=self.config.analytics_query_workers,
+            thread_name_prefix="analytics",
         )
+        self.local_cache = LocalCache(
+            maxsize=self.config.local_cache_size,
+            ttl=self.config.local_cache_ttl_seconds,
+        )
+        self.cache_fills = SingleFlight()
+        self.producer = producer_factory(self.config)
+
+    @cached_property
+    def db_client(self) -> AgnosticClient:
+        return self.connections.mongo
+
+    @cached_property
+    def database(self) -> Database:
+        return self.connections.database
+
+    @cached_property
+    def redis(self) -> aioredis.Redis:
+        return self.connections.redis
+
+    @cached_property
+    def read_and_decrement(self) -> Script:
+        return self.redis.register_script(READ_AND_DECREMENT)
+
+    @cached_property
+    def url_filter(self) -> BloomFilter:
+        return BloomFilter(
+            self.redis,
+            "tiny_urls",
+            self.config.url_filter_capacity,
+            self.config.url_filter_error_rate,
+            self.config.url_filter_ready_ttl_seconds,
+        )
+
+    @cached_property
+    def clickhouse_client(self) -> Client:
+        return self.connections.clickhouse
 
 
 class TypedRequest(Request):
@@ -0,0 +1,241 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from hashlib import blake2b
+from typing import Any, Awaitable, Callable, Hashable, Iterable, TypeVar
+
+import aioredis
+from aioredis.exceptions import LockError
+from motor.core import AgnosticCollection
+
+T = TypeVar("T")
+
+# Cached in place of links which don't exist.
+MISSING = b"null"
+
+# Returns the cached ``[url, max_redirects, expires_at]`` entry of KEYS[1] and
+# consumes one redirect of a limited link in the same round trip. The entry is
+# removed once the link expires, and it's replaced with the one of a missing
+# link together with the last redirect, so that the link isn't loaded again
+# before consumers have stored that it's used up. Every hit extends the entry
+# by ARGV[1] milliseconds up to ARGV[2] milliseconds, but never past the
+# expiry of the link, so popular links stay cached. Entries of missing links
+# are returned as they are, entries without an expiry were cached before it
+# was stored.
+READ_AND_DECREMENT = """
+local cached = redis.call("GET", KEYS[1])
+if not cached then
+    return false
+end
+local entry = cjson.decode(cached)
+if type(entry) ~= "table" then
+    return cached
+end
+local ttl = math.min(
+    math.max(redis.call("PTTL", KEYS[1]), 0) + tonumber(ARGV[1]), tonumber(ARGV[2])
+)
+local expires_at = entry[3]
+if expires_at ~= nil and expires_at ~= cjson.null then
+    local now = redis.call("TIME")
+    local left = (expires_at - tonumber(now[1])) * 1000 - math.floor(tonumber(now[2]) / 1000)
+    if left <= 0 then
+        redis.call("DEL", KEYS[1])
+        return false
+    end
+    ttl = math.min(ttl, left)
+end
+local remaining = entry[2]
+if remaining == nil or remaining == cjson.null then
+    redis.call("PEXPIRE", KEYS[1], ttl)
+    return cached
+end
+if remaining < 1 then
+    redis.call("SET", KEYS[1], "null", "PX", ttl)
+    return "null"
+end
+if remaining == 1 then
+    redis.call("SET", KEYS[1], "null", "PX", ttl)
+else
+    entry[2] = remaining - 1
+    redis.call("SET", KEYS[1], cjson.encode(entry), "PX", ttl)
+end
+return cached
+"""
+
+
+def capped_ttl(ttl: float, expires_at: float | None) -> float:
+    """``ttl`` in seconds, shortened so that an entry doesn't outlive its link."""
+    return ttl if expires_at is None else min(ttl, expires_at - time.time())
+
+
+class LocalCache:
+    """In-process LRU cache with an optional time to live for its entries."""
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._store: OrderedDict[Hashable, tuple[float | None, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self.get_any((key,), default)
+
+    def get_any(self, keys: Iterable[Hashable], default: Any = None) -> Any:
+        """Value of the first of ``keys`` which is cached, counted as one request."""
+        for key in keys:
+            try:
+                expires_at, value = self._store[key]
+            except KeyError:
+                continue
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._store[key]
+                continue
+            self._store.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._store[key] = (expires_at, value)
+        self._store.move_to_end(key)
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._store.pop(key, None)
+
+    def clear(self):
+        self._store.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._store),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._store
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+
+class SingleFlight:
+    """Runs one call per key at a time, concurrent callers share its result."""
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(function())
+            call.add_done_callback(lambda _: self._forget(key, call))
+        # A cancelled caller doesn't cancel the call others wait for.
+        return await asyncio.shield(call)
+
+    def _forget(self, key: Hashable, call: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class BloomFilter:
+    """Set of strings kept in a Redis bitmap which answers with false positives only.
+
+    The bitmap is sized for ``capacity`` items at the given false positive
+    rate, its key includes the size so that a filter with other parameters
+    is built from scratch. Until :meth:`rebuild` marks it as ready every
+    item is reported as possibly present. The mark expires after
+    ``ready_ttl`` seconds, so items which weren't added, e.g. by an older
+    version of the service, are picked up by the next rebuild, and it only
+    counts together with the bitmap, so an evicted bitmap isn't trusted.
+    """
+
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        key: str,
+        capacity: int,
+        error_rate: float,
+        ready_ttl: int,
+    ) -> None:
+        self.redis = redis
+        self.ready_ttl = ready_ttl
+        # Offsets of SETBIT are limited to 2^32 bits.
+        self.size = min(
+            math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 2**32
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.key = f"{key}:{self.size}:{self.hashes}"
+        self.ready_key = f"{self.key}:ready"
+
+    def positions(self, item: str) -> list[int]:
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    async def add(self, items: Iterable[str]):
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            for item in items:
+                for position in self.positions(item):
+                    pipeline.setbit(self.key, position, 1)
+            await pipeline.execute()
+
+    async def might_contain(self, item: str) -> bool:
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.exists(self.ready_key, self.key)
+            for position in self.positions(item):
+                pipeline.getbit(self.key, position)
+            ready, *bits = await pipeline.execute()
+        return ready < 2 or all(bits)
+
+    async def rebuild(
+        self,
+        collection: AgnosticCollection,
+        field: str,
+        lock_timeout: float,
+        batch_size: int = 10_000,
+    ) -> bool:
+        """Add ``field`` of every document unless the filter is ready already.
+
+        Only one process builds the filter at a time, the others return
+        ``False`` right away. Items added while it's built are kept.
+        """
+        lock = self.redis.lock(f"{self.key}:lock", timeout=lock_timeout)
+        if not await lock.acquire(blocking=False):
+            return False
+        try:
+            if await self.redis.exists(self.ready_key, self.key) == 2:
+                return True
+            batch = []
+            cursor = collection.find({}, {field: 1, "_id": 0}, batch_size=batch_size)
+            async for document in cursor:
+                batch.append(document[field])
+                if len(batch) >= batch_size:
+                    await self.add(batch)
+                    batch = []
+            await self.add(batch)
+            await self.redis.set(self.ready_key, 1, ex=self.ready_ttl)
+            return True
+        finally:
+            with suppress(LockError):
+                await lock.release()
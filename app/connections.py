@@ -0,0 +1,87 @@
+from functools import cached_property
+
+import aioredis
+from clickhouse_connect import common, get_client
+from clickhouse_connect.driver import Client, httputil
+from motor.core import AgnosticClient, Database
+from motor.motor_asyncio import AsyncIOMotorClient
+from urllib3 import PoolManager
+
+from app.config import Configuration
+
+# ClickHouse clients are shared by threads of executors, queries of a
+# session can't run concurrently.
+common.set_setting("autogenerate_session_id", False)
+
+
+class Connections:
+    """Clients of MongoDB, Redis and ClickHouse shared by a whole process.
+
+    Every client is created on first use with pools sized by the
+    configuration, :meth:`close` closes only the ones which were created.
+    """
+
+    def __init__(self, config: Configuration) -> None:
+        self.config = config
+
+    @cached_property
+    def mongo(self) -> AgnosticClient:
+        return AsyncIOMotorClient(
+            self.config.mongo_dsn,
+            maxPoolSize=self.config.mongo_max_pool_size,
+            minPoolSize=self.config.mongo_min_pool_size,
+            maxIdleTimeMS=self.config.mongo_max_idle_time_ms,
+            connectTimeoutMS=self.config.mongo_connect_timeout_ms,
+            serverSelectionTimeoutMS=self.config.mongo_server_selection_timeout_ms,
+            socketTimeoutMS=self.config.mongo_socket_timeout_ms,
+        )
+
+    @cached_property
+    def database(self) -> Database:
+        return self.mongo[self.config.mongo_database]
+
+    @cached_property
+    def redis(self) -> aioredis.Redis:
+        return aioredis.from_url(
+            self.config.redis_dsn,
+            max_connections=self.config.redis_max_connections,
+            socket_timeout=self.config.redis_socket_timeout_seconds,
+            socket_connect_timeout=self.config.redis_connect_timeout_seconds,
+            socket_keepalive=True,
+        )
+
+    @cached_property
+    def clickhouse_pool(self) -> PoolManager:
+        # Blocking pool makes threads wait for a free connection instead of
+        # opening ones which are thrown away after the request.
+        return httputil.get_pool_manager(
+            maxsize=self.config.clickhouse_pool_size,
+            block=True,
+            keep_idle=self.config.clickhouse_keep_alive_seconds,
+            keep_interval=self.config.clickhouse_keep_alive_seconds,
+        )
+
+    @cached_property
+    def clickhouse(self) -> Client:
+        return get_client(
+            dsn=self.config.clickhouse_dsn,
+            pool_mgr=self.clickhouse_pool,
+            connect_timeout=self.config.clickhouse_connect_timeout_seconds,
+            send_receive_timeout=self.config.clickhouse_query_timeout_seconds,
+        )
+
+    def opened(self, name: str) -> bool:
+        return name in self.__dict__
+
+    async def close(self):
+        if self.opened("mongo"):
+            self.mongo.close()
+        if self.opened("redis"):
+            await self.redis.close()
+            await self.redis.connection_pool.disconnect()
+        if self.opened("clickhouse"):
+            self.clickhouse.close()
+        if self.opened("clickhouse_pool"):
+            self.clickhouse_pool.clear()
+        for name in ("mongo", "database", "redis", "clickhouse", "clickhouse_pool"):
+            self.__dict__.pop(name, None)
@@ -1,26 +1,72 @@
 import asyncio
 import logging
+import time
 from functools import partial
-from typing import Any, Callable, Iterable
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Literal
 
-from aiokafka import AIOKafkaConsumer, ConsumerRecord
+from aiokafka import (
+    AIOKafkaConsumer,
+    ConsumerRebalanceListener,
+    ConsumerRecord,
+    TopicPartition,
+)
 
 from app.consumers.handlers import BaseHandler
 from app.consumers.middleware import BaseMiddleware
+from app.consumers.utils import OffsetTracker, RecordT
+
+
+class DrainOnRevoke(ConsumerRebalanceListener):
+    def __init__(self, consumer: "Consumer") -> None:
+        self.consumer = consumer
+
+    async def on_partitions_revoked(self, revoked: list[TopicPartition]):
+        await self.consumer.drain()
+        self.consumer.offsets.forget(revoked)
+
+    async def on_partitions_assigned(self, assigned: list[TopicPartition]):
+        pass
 
 
 class Consumer:
     handlers: dict[str, list[Callable[[ConsumerRecord], Any]]]
     middleware: list[BaseMiddleware]
+    hooks: dict[str, list[Callable[[], Awaitable[Any]]]]
     logger: logging.Logger
 
-    def __init__(self, bootstrap_servers, client_id, logger, services):
+    def __init__(
+        self,
+        bootstrap_servers,
+        client_id,
+        logger,
+        services,
+        *,
+        group_id: str | None = None,
+        concurrency: int = 1,
+        batch_size: int | None = None,
+        batch_timeout_ms: int = 500,
+        commit_interval: float = 5.0,
+    ):
         self.logger = logger
         self.consumer = partial(
-            AIOKafkaConsumer, bootstrap_servers=bootstrap_servers, client_id=client_id
+            AIOKafkaConsumer,
+            bootstrap_servers=bootstrap_servers,
+            client_id=client_id,
+            group_id=group_id,
+            enable_auto_commit=False,
         )
+        self.group_id = group_id
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.commit_interval = commit_interval
+        self.offsets = OffsetTracker()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails: dict[Hashable, asyncio.Task] = {}
+        self._last_commit = time.monotonic()
         self.handlers = {}
         self.middleware = []
+        self.hooks = {"startup": [], "shutdown": []}
         self.services = services or {}
 
     def declare_handler(self, handler: BaseHandler, topics: str | Iterable):
@@ -36,22 +82,176 @@ class Consumer:
         self.middleware.insert(0, middleware)
         self.logger.info("Declared middleware %s.", middleware)
 
+    def declare_hook(
+        self,
+        event: Literal["startup", "shutdown"],
+        hook: Callable[[], Awaitable[Any]],
+    ):
+        self.hooks[event].append(hook)
+        self.logger.info("Declared %s hook %s.", event, hook)
+
+    async def run_hooks(self, event: Literal["startup", "shutdown"]):
+        for hook in self.hooks[event]:
+            await hook()
+
     def handle(self, record: ConsumerRecord, stack):
         return asyncio.gather(
             *[handler(record) for handler in self.handlers[record.topic]]
         )
 
-    def stack(self):
+    def stack(self, handle: Callable | None = None):
         for middleware in self.middleware[1:]:
             yield middleware
-        yield self.handle
+        yield handle or self.handle
+
+    async def handle_batch(self, records: list[RecordT]):
+        records_by_topic: dict[str, list[RecordT]] = {}
+        for record in records:
+            records_by_topic.setdefault(record.topic, []).append(record)
+        await asyncio.gather(
+            *[
+                self._handle_topic_batch(handler, topic_records)
+                for topic, topic_records in records_by_topic.items()
+                for handler in self.handlers[topic]
+            ]
+        )
+
+    async def _handle_topic_batch(self, handler, records: list[RecordT]):
+        try:
+            if isinstance(handler, BaseHandler):
+                await handler.handle_batch(records)
+            else:
+                for record in records:
+                    await handler(record)
+        except Exception as exc:
+            self.logger.exception(
+                "Exception %s while processing %s records on topic %s with %s",
+                exc,
+                len(records),
+                records[0].topic,
+                handler,
+            )
+
+    async def process_batch(self, records: list[ConsumerRecord]):
+        """Run records through middleware, then pass them to handlers together."""
+        parsed: list[RecordT] = []
+
+        async def collect(record: RecordT, stack):
+            parsed.append(record)
+
+        for record in records:
+            self.offsets.begin(
+                TopicPartition(record.topic, record.partition), record.offset
+            )
+            await self.middleware[0](record, self.stack(collect))
+        await self.handle_batch(parsed)
+        for record in records:
+            self.offsets.finish(
+                TopicPartition(record.topic, record.partition), record.offset
+            )
+
+    @staticmethod
+    def ordering_key(record: ConsumerRecord) -> Hashable:
+        """Records sharing this key are processed one after another."""
+        return record.topic, record.partition, record.key
+
+    async def process(self, record: ConsumerRecord, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.middleware[0](record, self.stack())
+
+    def schedule(self, record: ConsumerRecord) -> asyncio.Task:
+        key = self.ordering_key(record)
+        partition = TopicPartition(record.topic, record.partition)
+        self.offsets.begin(partition, record.offset)
+        task = asyncio.create_task(self.process(record, self._tails.get(key)))
+        self._tails[key] = task
+
+        def _finished(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                self.logger.error(
+                    "Processing record %s failed.", record, exc_info=task.exception()
+                )
+            self._slots.release()
+            self.offsets.finish(partition, record.offset)
+            if self._tails.get(key) is task:
+                del self._tails[key]
+
+        task.add_done_callback(_finished)
+        return task
+
+    async def flush_handlers(self, committed: dict[TopicPartition, int]):
+        handlers = {
+            handler
+            for handlers in self.handlers.values()
+            for handler in handlers
+            if isinstance(handler, BaseHandler)
+        }
+        await asyncio.gather(*[handler.flush(committed) for handler in handlers])
+
+    async def commit(self):
+        self._last_commit = time.monotonic()
+        offsets = self.offsets.pop_committable()
+        if not offsets:
+            return
+        # Handlers may buffer work, it has to be persisted before the offsets
+        # of the records it came from are committed.
+        try:
+            await self.flush_handlers(offsets)
+            if self.group_id is not None:
+                await self.consumer.commit(offsets)
+        except Exception:
+            self.offsets.restore(offsets)
+            raise
+
+    async def drain(self):
+        """Wait for every scheduled record and commit their offsets."""
+        await asyncio.gather(*self._tails.values(), return_exceptions=True)
+        await self.commit()
+
+    async def _consume_records(self):
+        while True:
+            # A record is awaited only until the next commit is due, so that
+            # buffered work is flushed while no records arrive.
+            timeout = self._last_commit + self.commit_interval - time.monotonic()
+            try:
+                record = await asyncio.wait_for(
+                    self.consumer.getone(), timeout=max(timeout, 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+            else:
+                await self._slots.acquire()
+                self.schedule(record)
+            if time.monotonic() - self._last_commit >= self.commit_interval:
+                await self.commit()
+
+    async def _consume_batches(self):
+        while True:
+            batches = await self.consumer.getmany(
+                timeout_ms=self.batch_timeout_ms, max_records=self.batch_size
+            )
+            records = [record for records in batches.values() for record in records]
+            if records:
+                await self.process_batch(records)
+            if time.monotonic() - self._last_commit >= self.commit_interval:
+                await self.commit()
 
     async def run(self):
-        self.consumer = self.consumer(*list(self.handlers.keys()))
+        self.consumer = self.consumer()
+        await self.run_hooks("startup")
         await self.consumer.start()
+        self.consumer.subscribe(
+            list(self.handlers.keys()), listener=DrainOnRevoke(self)
+        )
         try:
-            async for record in self.consumer:
-                print(record)
-                await self.middleware[0](record, self.stack())
+            if self.batch_size:
+                await self._consume_batches()
+            else:
+                await self._consume_records()
         finally:
-            await self.consumer.stop()
+            try:
+                await self.drain()
+                await self.run_hooks("shutdown")
+            finally:
+                await self.consumer.stop()
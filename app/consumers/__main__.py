@@ -1,62 +1,113 @@
 import asyncio
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import aiorun
-import clickhouse_connect
 from geoip2.database import Reader
-from clickhouse_connect.driver import exceptions as clickhouse_exceptions
 from motor.core import Database
-from motor.motor_asyncio import AsyncIOMotorClient
 from nanoid import generate
 
 from app.config import configuration
+from app.connections import Connections
 from app.consumers import Consumer
-from app.consumers.handlers import HandleAnalytics, HandleLastVisitTime, HandleMetrics
+from app.consumers.enrichment import initialize_worker
+from app.consumers.handlers import (
+    ANALYTICS_COLUMNS,
+    HandleAnalytics,
+    HandleLastVisitTime,
+    HandleMetrics,
+)
 from app.consumers.middleware import (
     ExceptionMiddleware,
     LoggingMiddleware,
     OrJSONMiddleware,
     TimingMiddleware,
 )
+from app.consumers.schema import create_tables_exclusively
+from app.consumers.sinks import ClickHouseSink
 
 
 async def main():
-    db_client = AsyncIOMotorClient(configuration.mongo_dsn)
-    clickhouse_client = clickhouse_connect.get_client(host="clickhouse", password="")
-    ip_reader = Reader("./GeoLite2-Country.mmdb")
-    try:
-        clickhouse_client.command(
-            "CREATE TABLE analytics (host String, path String, tiny_url String, timestamp DateTime, ip_address String, location String, device String, operating_system String, browser String, is_mobile Bool, is_bot Bool) ENGINE = MergeTree() PRIMARY KEY (tiny_url, timestamp, ip_address)"
-        )
-    except clickhouse_exceptions.DatabaseError:
-        pass
-    database: Database = db_client["test"]
+    connections = Connections(configuration)
+    clickhouse_client = connections.clickhouse
+    ip_reader = Reader(configuration.geoip_database)
+    await create_tables_exclusively(
+        connections.redis,
+        clickhouse_client,
+        configuration.analytics_ttl_days,
+        configuration.analytics_migration_lock_seconds,
+    )
+    database: Database = connections.database
 
     consumer_id = f"invisible-{generate(size=8)}"
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(consumer_id)
 
+    analytics_sink = ClickHouseSink(
+        clickhouse_client,
+        "analytics",
+        ANALYTICS_COLUMNS,
+        max_batch_size=configuration.analytics_batch_size,
+        flush_interval=configuration.analytics_flush_interval_seconds,
+        max_pending_batches=configuration.analytics_max_pending_batches,
+        logger=logger,
+    )
+
+    enrichment_executor = None
+    if configuration.enrichment_processes:
+        enrichment_executor = ProcessPoolExecutor(
+            max_workers=configuration.enrichment_processes,
+            initializer=initialize_worker,
+            initargs=(configuration.geoip_database,),
+        )
+
     consumer = Consumer(
         logger=logger,
         bootstrap_servers=f"{configuration.kafka_dsn.host}:{configuration.kafka_dsn.port}",
         client_id=consumer_id,
+        group_id=configuration.kafka_consumer_group,
+        concurrency=configuration.consumer_concurrency,
+        batch_size=configuration.consumer_batch_size,
+        batch_timeout_ms=configuration.consumer_batch_timeout_ms,
+        commit_interval=configuration.consumer_commit_interval_seconds,
         services={
             "tinyurl_collection": database["tinyurl"],
             "host_metrics_collection": database["host_metrics"],
             "path_metrics_collection": database["path_metrics"],
             "clickhouse_client": clickhouse_client,
+            "analytics_sink": analytics_sink,
             "ip_reader": ip_reader,
+            "enrichment_executor": enrichment_executor,
         },
     )
 
+    consumer.declare_hook("startup", analytics_sink.start)
+    consumer.declare_hook("shutdown", analytics_sink.close)
+    consumer.declare_hook("shutdown", connections.close)
+    if enrichment_executor is not None:
+
+        async def _shutdown_enrichment_executor():
+            enrichment_executor.shutdown(cancel_futures=True)
+
+        consumer.declare_hook("shutdown", _shutdown_enrichment_executor)
+
     consumer.declare_middleware(OrJSONMiddleware())
     consumer.declare_middleware(ExceptionMiddleware(logger))
     consumer.declare_middleware(TimingMiddleware(logger))
     consumer.declare_middleware(LoggingMiddleware(logger))
 
     consumer.declare_handler(HandleLastVisitTime(), "URL.read")
-    consumer.declare_handler(HandleMetrics(), ("URL.read", "URL.create"))
-    consumer.declare_handler(HandleAnalytics(), ("URL.read"))
+    consumer.declare_handler(
+        HandleMetrics(aggregate=configuration.consumer_aggregate_metrics),
+        ("URL.read", "URL.create"),
+    )
+    consumer.declare_handler(
+        HandleAnalytics(
+            user_agent_cache_size=configuration.user_agent_cache_size,
+            geoip_cache_size=configuration.geoip_cache_size,
+        ),
+        ("URL.read"),
+    )
 
     await consumer.run()
 
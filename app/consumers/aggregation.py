@@ -0,0 +1,115 @@
+from array import array
+from bisect import bisect_left
+from typing import Any, Callable
+
+from aiokafka import TopicPartition
+from motor.core import Collection
+from pymongo import UpdateOne
+
+BucketT = tuple[str, TopicPartition, str]
+
+
+def offset_key(partition: TopicPartition) -> str:
+    return f"{partition.topic.replace('.', '_')}-{partition.partition}"
+
+
+class CounterAggregator:
+    """Sums counter increments per document until they are written at once.
+
+    Increments are kept per document, partition and counter together with
+    offsets of records they came from. Every write stores the last applied
+    offset of a partition in the document (``offsets.<topic>-<partition>``)
+    within the same update as the increment, so records replayed after a
+    crash between a write and the offset commit are recognized and are not
+    counted twice.
+    """
+
+    def __init__(self, collection: Collection, key_field: str) -> None:
+        self.collection = collection
+        self.key_field = key_field
+        self._pending: dict[BucketT, array] = {}
+
+    def add(self, key: str, partition: TopicPartition, offset: int, field: str):
+        self._pending.setdefault((key, partition, field), array("q")).append(offset)
+
+    def pending_keys(self) -> set[str]:
+        return {key for key, _, _ in self._pending}
+
+    def restore(self, buckets: dict[BucketT, list[int]]):
+        """Put back increments taken for a write which failed."""
+        for bucket, offsets in buckets.items():
+            self._pending.setdefault(bucket, array("q")).extend(offsets)
+
+    def take(
+        self, committed: dict[TopicPartition, int] | None = None
+    ) -> dict[BucketT, list[int]]:
+        """Remove and return increments of records before the committed offsets."""
+        taken = {}
+        for bucket, offsets in list(self._pending.items()):
+            partition = bucket[1]
+            if committed is None:
+                taken[bucket] = sorted(offsets)
+                del self._pending[bucket]
+            elif partition in committed:
+                offsets = sorted(offsets)
+                split = bisect_left(offsets, committed[partition])
+                if split:
+                    taken[bucket] = offsets[:split]
+                if split == len(offsets):
+                    del self._pending[bucket]
+                else:
+                    self._pending[bucket] = array("q", offsets[split:])
+        return taken
+
+    async def write(
+        self,
+        buckets: dict[BucketT, list[int]],
+        ensure: Callable[[str], dict[str, Any]],
+    ):
+        """Apply increments to documents upserted with ``ensure`` updates first."""
+        if not buckets:
+            return
+        keys = {key for key, _, _ in buckets}
+        operations = [
+            UpdateOne({self.key_field: key}, ensure(key), upsert=True) for key in keys
+        ]
+        for (key, partition, field), offsets in buckets.items():
+            watermark = f"offsets.{offset_key(partition)}"
+            operations.append(
+                UpdateOne(
+                    {self.key_field: key, watermark: {"$not": {"$gte": offsets[0]}}},
+                    {"$inc": {field: len(offsets)}, "$set": {watermark: offsets[-1]}},
+                )
+            )
+        result = await self.collection.bulk_write(operations, ordered=True)
+        applied = result.matched_count - (len(keys) - result.upserted_count)
+        if applied < len(buckets):
+            await self._write_replayed(buckets)
+
+    async def _write_replayed(self, buckets: dict[BucketT, list[int]]):
+        # Some buckets overlap offsets that were already written, only the
+        # increments of records past the stored watermark are applied.
+        watermarks = {
+            document[self.key_field]: document.get("offsets", {})
+            async for document in self.collection.find(
+                {self.key_field: {"$in": list({key for key, _, _ in buckets})}},
+                {self.key_field: 1, "offsets": 1},
+            )
+        }
+        operations = []
+        for (key, partition, field), offsets in buckets.items():
+            stored = watermarks.get(key, {}).get(offset_key(partition))
+            remaining = [
+                offset for offset in offsets if stored is None or offset > stored
+            ]
+            if not remaining:
+                continue
+            watermark = f"offsets.{offset_key(partition)}"
+            operations.append(
+                UpdateOne(
+                    {self.key_field: key, watermark: stored},
+                    {"$inc": {field: len(remaining)}, "$set": {watermark: offsets[-1]}},
+                )
+            )
+        if operations:
+            await self.collection.bulk_write(operations, ordered=True)
@@ -0,0 +1,159 @@
+import asyncio
+from concurrent.futures import Executor
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+
+from geoip2.database import Reader
+from geoip2.errors import AddressNotFoundError
+from user_agents import parse
+
+from app.cache import LocalCache
+
+UserAgentT = tuple[str, str, str, bool, bool]
+
+UNKNOWN_LOCATION = "Unknown"
+UNKNOWN_USER_AGENT: UserAgentT = ("Unknown", "Unknown", "Unknown", False, False)
+
+
+class UserAgentParser:
+    """Parses User-Agent strings, results of recently seen ones are cached.
+
+    A parsed User-Agent is a tuple of device, operating system, browser and
+    whether it is a mobile device and a bot.
+    """
+
+    def __init__(self, cache_size: int = 4096) -> None:
+        self.cache = LocalCache(maxsize=cache_size)
+
+    def __call__(self, user_agent: str | None) -> UserAgentT:
+        parsed = self.cached(user_agent)
+        if parsed is None:
+            parsed = self.parse(user_agent)
+            self.cache.set(user_agent, parsed)
+        return parsed
+
+    def cached(self, user_agent: str | None) -> UserAgentT | None:
+        if not user_agent:
+            return UNKNOWN_USER_AGENT
+        return self.cache.get(user_agent)
+
+    @staticmethod
+    def parse(user_agent: str) -> UserAgentT:
+        user_agent = parse(user_agent)
+        browser = f"{user_agent.os.family} {user_agent.os.version_string}"
+        operating_system = (
+            f"{user_agent.browser.family} {user_agent.browser.version_string}"
+        )
+        return (
+            user_agent.device.family,
+            operating_system,
+            browser,
+            user_agent.is_mobile,
+            user_agent.is_bot,
+        )
+
+
+class GeoIPResolver:
+    """Resolves country ISO codes of IP addresses.
+
+    Addresses which aren't globally routable are never looked up. A result
+    is cached for the whole /24 (/48 for IPv6) network of the address when
+    GeoIP reports it for a network at least that large, otherwise for the
+    address alone.
+    """
+
+    def __init__(self, reader: Reader, cache_size: int = 65536) -> None:
+        self.reader = reader
+        self.cache = LocalCache(maxsize=cache_size)
+
+    def __call__(self, address: str | None) -> str:
+        location = self.cached(address)
+        if location is None:
+            location, key = self.lookup(address)
+            self.cache.set(key, location)
+        return location
+
+    def cached(self, address: str | None) -> str | None:
+        try:
+            address = ip_address(address)
+        except ValueError:
+            return UNKNOWN_LOCATION
+        if not address.is_global:
+            return UNKNOWN_LOCATION
+        return self.cache.get_any((self.network_key(address), str(address)))
+
+    def lookup(self, address: str) -> tuple[str, str]:
+        """Look the address up in GeoIP and return the location and its cache key."""
+        try:
+            response = self.reader.country(address)
+            location, network = response.country.iso_code, response.traits.network
+        except AddressNotFoundError as exc:
+            location, network = None, getattr(exc, "network", None)
+        address = ip_address(address)
+        key = self.network_key(address)
+        if network is None or not ip_network(key).subnet_of(network):
+            key = str(address)
+        return location or UNKNOWN_LOCATION, key
+
+    @staticmethod
+    def network_key(address: IPv4Address | IPv6Address) -> str:
+        prefix = 24 if isinstance(address, IPv4Address) else 48
+        return str(ip_network((address, prefix), strict=False))
+
+
+class Enricher:
+    """Resolves location and User-Agent details of a visit.
+
+    Lookups missing from the caches may run in a process pool, which has to
+    be created with :func:`initialize_worker`, so that they don't compete
+    with Kafka I/O for the event loop.
+    """
+
+    def __init__(
+        self,
+        geoip: GeoIPResolver,
+        user_agents: UserAgentParser,
+        executor: Executor | None = None,
+    ) -> None:
+        self.geoip = geoip
+        self.user_agents = user_agents
+        self.executor = executor
+
+    async def __call__(
+        self, address: str | None, user_agent: str | None
+    ) -> tuple[str, UserAgentT]:
+        if self.executor is None:
+            return self.geoip(address), self.user_agents(user_agent)
+        location = self.geoip.cached(address)
+        parsed = self.user_agents.cached(user_agent)
+        if location is None or parsed is None:
+            loop = asyncio.get_running_loop()
+            looked_up, parsed_in_worker = await loop.run_in_executor(
+                self.executor,
+                _enrich,
+                address if location is None else None,
+                user_agent if parsed is None else None,
+            )
+            if location is None:
+                location, key = looked_up
+                self.geoip.cache.set(key, location)
+            if parsed is None:
+                parsed = parsed_in_worker
+                self.user_agents.cache.set(user_agent, parsed)
+        return location, parsed
+
+
+_worker_geoip: GeoIPResolver | None = None
+
+
+def initialize_worker(database: str):
+    global _worker_geoip
+    _worker_geoip = GeoIPResolver(Reader(database), cache_size=1)
+
+
+def _enrich(
+    address: str | None, user_agent: str | None
+) -> tuple[tuple[str, str] | None, UserAgentT | None]:
+    return (
+        _worker_geoip.lookup(address) if address is not None else None,
+        UserAgentParser.parse(user_agent) if user_agent is not None else None,
+    )
@@ -1,22 +1,37 @@
-import asyncio
 import logging
 from abc import ABC, abstractmethod
+from collections import Counter
 from datetime import datetime
+from functools import cached_property
+from ipaddress import ip_address
 from typing import Any
-from clickhouse_connect.driver import Client
-from geoip2.database import Reader
-from geoip2.errors import AddressNotFoundError
-from user_agents import parse
 
+from aiokafka import TopicPartition
+from bson import ObjectId
 from motor.core import Collection
+from pymongo import UpdateOne
 from pymongo.collection import ReturnDocument
 
+from app.consumers.aggregation import CounterAggregator
+from app.consumers.enrichment import Enricher, GeoIPResolver, UserAgentParser
+from app.consumers.sinks import ClickHouseSink
 from app.consumers.utils import RecordT
 from app.models import URL
-from app.models.metrics import Host, Path
 
 
-PRIVATE_IP_ADDRESS = "192.168.1.1"
+ANALYTICS_COLUMNS = (
+    "host",
+    "path",
+    "tiny_url",
+    "timestamp",
+    "ip_address",
+    "location",
+    "device",
+    "operating_system",
+    "browser",
+    "is_mobile",
+    "is_bot",
+)
 
 
 class BaseHandler(ABC):
@@ -35,11 +50,19 @@ class BaseHandler(ABC):
     async def __call__(self, record: RecordT) -> Any:
         raise NotImplementedError()
 
+    async def handle_batch(self, records: list[RecordT]) -> Any:
+        """Handle records polled together, override to process them in bulk."""
+        for record in records:
+            await self(record)
+
+    async def flush(self, committed: dict[TopicPartition, int] | None = None):
+        """Persist buffered work before ``committed`` offsets are committed."""
+
 
 class HandleLastVisitTime(BaseHandler):
     async def __call__(self, record: RecordT) -> Any:
         tiny_url_collection: Collection = self.services["tinyurl_collection"]
-        url = await tiny_url_collection.find_one({"tiny_url": record.value["tiny_url"]})
+        url = await tiny_url_collection.find_one({"tiny_url": record.event.tiny_url})
 
         url = URL(**url)
         record_datetime = datetime.fromtimestamp(record.timestamp / 1000)
@@ -51,129 +74,262 @@ class HandleLastVisitTime(BaseHandler):
                 update_fields["$inc"] = {"max_redirects": -1}
             await tiny_url_collection.update_one({"_id": url.id}, update_fields)
 
+    async def handle_batch(self, records: list[RecordT]) -> Any:
+        tiny_url_collection: Collection = self.services["tinyurl_collection"]
+
+        visits: dict[str, tuple[datetime, int]] = {}
+        for record in records:
+            record_datetime = datetime.fromtimestamp(record.timestamp / 1000)
+            last_visit_time, visits_number = visits.get(
+                record.event.tiny_url, (record_datetime, 0)
+            )
+            visits[record.event.tiny_url] = (
+                max(last_visit_time, record_datetime),
+                visits_number + 1,
+            )
+
+        operations = []
+        for tiny_url, (last_visit_time, visits_number) in visits.items():
+            not_visited_since = {
+                "tiny_url": tiny_url,
+                "$or": [
+                    {"last_visit_time": None},
+                    {"last_visit_time": {"$lt": last_visit_time}},
+                ],
+            }
+            if visits_number > 1:
+                operations.append(
+                    UpdateOne(
+                        not_visited_since
+                        | {"max_redirects": {"$gt": 0, "$lt": visits_number}},
+                        {"$set": {"max_redirects": 0}},
+                    )
+                )
+            operations += [
+                UpdateOne(
+                    not_visited_since | {"max_redirects": {"$gte": visits_number}},
+                    {"$inc": {"max_redirects": -visits_number}},
+                ),
+                UpdateOne(
+                    not_visited_since, {"$set": {"last_visit_time": last_visit_time}}
+                ),
+            ]
+        await tiny_url_collection.bulk_write(operations, ordered=True)
+
 
 class HandleAnalytics(BaseHandler):
-    async def __call__(self, record: RecordT) -> Any:
-        client: Client = self.services["clickhouse_client"]
-        ip_reader: Reader = self.services["ip_reader"]
+    def __init__(
+        self, user_agent_cache_size: int = 4096, geoip_cache_size: int = 65536
+    ) -> None:
+        self.parse_user_agent = UserAgentParser(user_agent_cache_size)
+        self.geoip_cache_size = geoip_cache_size
 
-        url = URL(**record.value)
-        try:
-            location = ip_reader.country(
-                record.value.get("ip_address", PRIVATE_IP_ADDRESS) or PRIVATE_IP_ADDRESS
-            ).country.iso_code
-        except AddressNotFoundError:
-            location = "Unknown"
-        if "user_agent" in record.value and record.value.get("user_agent"):
-            user_agent = parse(record.value["user_agent"])
+    @cached_property
+    def enrich(self) -> Enricher:
+        return Enricher(
+            GeoIPResolver(self.services["ip_reader"], self.geoip_cache_size),
+            self.parse_user_agent,
+            self.services.get("enrichment_executor"),
+        )
+
+    async def flush(self, committed: dict[TopicPartition, int] | None = None):
+        await self.services["analytics_sink"].flush()
+        self.logger.info(
+            "User agent cache stats: %s, GeoIP cache stats: %s",
+            self.parse_user_agent.cache.info(),
+            self.enrich.geoip.cache.info(),
+        )
+
+    @staticmethod
+    def ip_column(address: str | None) -> str:
+        """The address if it's valid, ``::`` otherwise.
 
+        The column isn't nullable and the client serializes a column by the
+        type of its first value, so every row holds an address string.
+        """
         try:
-            device = user_agent.device.family
-            browser = f"{user_agent.os.family} {user_agent.os.version_string}"
-            operating_system = (
-                f"{user_agent.browser.family} {user_agent.browser.version_string}"
-            )
-            is_mobile = user_agent.is_mobile
-            is_bot = user_agent.is_bot
-        except UnboundLocalError:
-            device, browser, operating_system = ("Unknown",) * 3
-            is_mobile, is_bot = (False,) * 2
-        client.insert(
-            "analytics",
-            [
-                (
-                    url.url.host,
-                    str(url.url),
-                    url.tiny_url,
-                    datetime.fromtimestamp(record.timestamp / 1000),
-                    record.value.get("ip_address"),
-                    location,
-                    device,
-                    operating_system,
-                    browser,
-                    is_mobile,
-                    is_bot,
-                )
-            ],
+            ip_address(address)
+        except ValueError:
+            return "::"
+        return address
+
+    async def __call__(self, record: RecordT) -> Any:
+        sink: ClickHouseSink = self.services["analytics_sink"]
+
+        event = record.event
+        (
+            location,
+            (device, operating_system, browser, is_mobile, is_bot),
+        ) = await self.enrich(event.ip_address, event.user_agent)
+        await sink.put(
             (
-                "host",
-                "path",
-                "tiny_url",
-                "timestamp",
-                "ip_address",
-                "location",
-                "device",
-                "operating_system",
-                "browser",
-                "is_mobile",
-                "is_bot",
-            ),
+                event.host,
+                event.url,
+                event.tiny_url,
+                datetime.fromtimestamp(record.timestamp / 1000),
+                self.ip_column(event.ip_address),
+                location,
+                device,
+                operating_system,
+                browser,
+                is_mobile,
+                is_bot,
+            )
         )
 
 
 class HandleMetrics(BaseHandler):
+    """Updates host and path metrics.
+
+    With ``aggregate`` the increments are summed in memory and written when
+    the consumer commits offsets instead of on every record.
+    """
+
+    def __init__(self, aggregate: bool = False) -> None:
+        self.aggregate = aggregate
+        self._path_hosts: dict[str, str] = {}
+
+    @cached_property
+    def path_counters(self) -> CounterAggregator:
+        return CounterAggregator(self.services["path_metrics_collection"], "url")
+
+    @cached_property
+    def host_counters(self) -> CounterAggregator:
+        return CounterAggregator(self.services["host_metrics_collection"], "host")
+
     async def __call__(self, record: RecordT) -> Any:
-        # TODO: Refactor this handler
+        if self.aggregate:
+            return self.add(record)
         host_metrics_collection: Collection = self.services["host_metrics_collection"]
         path_metrics_collection: Collection = self.services["path_metrics_collection"]
 
-        url = URL(**record.value)
-        host_url = url.url.host.replace("www.", "")
+        event = record.event
+        host_url = event.host.replace("www.", "")
+        path_field, host_field = self.metric_fields(record)
 
-        host_metrics, path_metrics = await asyncio.gather(
-            *[
-                host_metrics_collection.find_one({"host": host_url}),
-                path_metrics_collection.find_one({"url": url.url}),
-            ]
-        )
-        redirects_number = 1 if record.topic.endswith("read") else 0
-        incremented_fields = (
-            {"redirects"} if record.topic.endswith("read") else {"tiny_urls"}
-        )
-        tiny_urls = 0 if record.topic.endswith("read") else 1
-        path_metrics = (
-            Path(**path_metrics)
-            if path_metrics
-            else Path(url=url.url, redirects=redirects_number, tiny_urls=tiny_urls)
-        )
-        fields_to_set = path_metrics.dict(
-            exclude=incremented_fields | {"id", "path"},
-        )
-        fields_to_set.update({"search": path_metrics.url})
-        r = await path_metrics_collection.find_one_and_update(
-            {"url": path_metrics.url},
-            {
-                "$set": fields_to_set,
-                "$inc": {inc_field: 1 for inc_field in incremented_fields},
-            },
+        path_metrics = await path_metrics_collection.find_one_and_update(
+            {"url": event.url},
+            self.path_update(event.url, {path_field: 1}),
+            projection={"_id": 1},
             upsert=True,
             return_document=ReturnDocument.AFTER,
         )
-        host_metrics = (
-            Host(**host_metrics)
-            if host_metrics
-            else Host(
-                paths_ids=[],
-                host=host_url,
-                total_redirects=redirects_number,
-                tiny_urls=tiny_urls,
-            )
+        await host_metrics_collection.update_one(
+            {"host": host_url},
+            self.host_update(host_url, {host_field: 1}, [path_metrics["_id"]]),
+            upsert=True,
         )
-        host_metrics.paths_ids.append(r["_id"])
-        incremented_fields = (
-            {"total_redirects"}
-            if record.topic.endswith("read")
-            else {"total_tiny_urls"}
+
+    @staticmethod
+    def metric_fields(record: RecordT) -> tuple[str, str]:
+        """Names of the path and host counters incremented by the record."""
+        if record.topic.endswith("read"):
+            return "redirects", "total_redirects"
+        return "tiny_urls", "total_tiny_urls"
+
+    @staticmethod
+    def path_update(path: str, counters: dict[str, int]) -> dict[str, Any]:
+        return {"$inc": counters, "$setOnInsert": {"search": path}}
+
+    @staticmethod
+    def host_update(
+        host: str, counters: dict[str, int], paths_ids: list[ObjectId]
+    ) -> dict[str, Any]:
+        update = {
+            "$setOnInsert": {"search": host},
+            "$addToSet": {"paths_ids": {"$each": paths_ids}},
+        }
+        if counters:
+            update["$inc"] = counters
+        return update
+
+    def add(self, record: RecordT):
+        event = record.event
+        host_url = event.host.replace("www.", "")
+        path_field, host_field = self.metric_fields(record)
+        partition = TopicPartition(record.topic, record.parition)
+        self.path_counters.add(event.url, partition, record.offset, path_field)
+        self.host_counters.add(host_url, partition, record.offset, host_field)
+        self._path_hosts[event.url] = host_url
+
+    async def flush(self, committed: dict[TopicPartition, int] | None = None):
+        if not self.aggregate:
+            return
+        paths, hosts = (
+            self.path_counters.take(committed),
+            self.host_counters.take(committed),
         )
-        fields_to_set = host_metrics.dict(
-            exclude=incremented_fields | {"id", "path"},
+        try:
+            await self.path_counters.write(
+                paths, lambda path: {"$setOnInsert": {"search": path}}
+            )
+            path_ids = await self.path_ids({path for path, _, _ in paths})
+            host_paths: dict[str, list[ObjectId]] = {}
+            for path, path_id in path_ids.items():
+                host_paths.setdefault(self._path_hosts[path], []).append(path_id)
+            await self.host_counters.write(
+                hosts,
+                lambda host: self.host_update(host, {}, host_paths.get(host, [])),
+            )
+        except Exception:
+            self.path_counters.restore(paths)
+            self.host_counters.restore(hosts)
+            raise
+        pending_paths = self.path_counters.pending_keys()
+        self._path_hosts = {
+            path: host
+            for path, host in self._path_hosts.items()
+            if path in pending_paths
+        }
+
+    async def path_ids(self, paths: set[str]) -> dict[str, ObjectId]:
+        if not paths:
+            return {}
+        path_metrics_collection: Collection = self.services["path_metrics_collection"]
+        return {
+            path["url"]: path["_id"]
+            async for path in path_metrics_collection.find(
+                {"url": {"$in": list(paths)}}, {"_id": 1, "url": 1}
+            )
+        }
+
+    async def handle_batch(self, records: list[RecordT]) -> Any:
+        if self.aggregate:
+            for record in records:
+                self.add(record)
+            return
+        host_metrics_collection: Collection = self.services["host_metrics_collection"]
+        path_metrics_collection: Collection = self.services["path_metrics_collection"]
+
+        paths: dict[str, Counter] = {}
+        hosts: dict[str, Counter] = {}
+        host_paths: dict[str, set[str]] = {}
+        for record in records:
+            event = record.event
+            host_url = event.host.replace("www.", "")
+            path_field, host_field = self.metric_fields(record)
+            paths.setdefault(event.url, Counter())[path_field] += 1
+            hosts.setdefault(host_url, Counter())[host_field] += 1
+            host_paths.setdefault(host_url, set()).add(event.url)
+
+        await path_metrics_collection.bulk_write(
+            [
+                UpdateOne({"url": path}, self.path_update(path, counters), upsert=True)
+                for path, counters in paths.items()
+            ],
+            ordered=False,
         )
-        fields_to_set.update({"search": host_metrics.host})
-        await host_metrics_collection.find_one_and_update(
-            {"host": host_metrics.host},
-            {
-                "$set": fields_to_set,
-                "$inc": {inc_field: 1 for inc_field in incremented_fields},
-            },
-            upsert=True,
+        path_ids = await self.path_ids(set(paths))
+        await host_metrics_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"host": host},
+                    self.host_update(
+                        host, counters, [path_ids[path] for path in host_paths[host]]
+                    ),
+                    upsert=True,
+                )
+                for host, counters in hosts.items()
+            ],
+            ordered=False,
         )
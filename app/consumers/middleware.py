@@ -4,10 +4,10 @@ from typing import Any, Callable, Coroutine, Generator
 import time
 from enum import Enum, auto
 
-import orjson
 from aiokafka import ConsumerRecord
 
 from app.consumers.utils import ParsedRecord, RecordT
+from app.messaging.encoding import decode
 
 
 class BaseMiddleware(ABC):
@@ -43,6 +43,8 @@ class ExceptionMiddleware(LoggingMiddleware):
 
 
 class OrJSONMiddleware(BaseMiddleware):
+    """Parses values of JSON and compact messages, see :mod:`app.messaging.encoding`."""
+
     async def __call__(self, record: ConsumerRecord, stack: Generator) -> Any:
         await next(stack)(
             ParsedRecord(
@@ -52,7 +54,8 @@ class OrJSONMiddleware(BaseMiddleware):
                 offset=record.offset,
                 timestamp=record.timestamp,
                 timestamp_type=record.timestamp_type,
-                value=orjson.loads(record.value),
+                value=decode(record.value, record.headers),
+                headers=record.headers,
             ),
             stack,
         )
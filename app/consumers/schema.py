@@ -0,0 +1,225 @@
+import logging
+from typing import Callable
+
+import aioredis
+from clickhouse_connect.driver import Client
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version UInt32,
+    applied_at DateTime DEFAULT now()
+)
+ENGINE = MergeTree()
+ORDER BY version
+"""
+
+LEGACY_ANALYTICS_TABLE = """
+CREATE TABLE IF NOT EXISTS analytics (
+    host String,
+    path String,
+    tiny_url String,
+    timestamp DateTime,
+    ip_address String,
+    location String,
+    device String,
+    operating_system String,
+    browser String,
+    is_mobile Bool,
+    is_bot Bool
+)
+ENGINE = MergeTree()
+PRIMARY KEY (tiny_url, timestamp, ip_address)
+"""
+
+# IPv4 addresses are stored mapped into IPv6, ``::`` stands for an unknown one.
+ANALYTICS_TABLE = """
+CREATE TABLE {name} (
+    host LowCardinality(String),
+    path String CODEC(ZSTD(3)),
+    tiny_url String CODEC(ZSTD(1)),
+    timestamp DateTime CODEC(Delta, ZSTD(1)),
+    ip_address IPv6 CODEC(ZSTD(1)),
+    location LowCardinality(String),
+    device LowCardinality(String),
+    operating_system LowCardinality(String),
+    browser LowCardinality(String),
+    is_mobile Bool,
+    is_bot Bool
+)
+ENGINE = MergeTree()
+PARTITION BY toYYYYMM(timestamp)
+ORDER BY (tiny_url, timestamp, ip_address)
+"""
+
+ANALYTICS_DAILY_TABLE = """
+CREATE TABLE analytics_daily (
+    tiny_url String,
+    day Date,
+    visits SimpleAggregateFunction(sum, UInt64),
+    unique_visits AggregateFunction(uniqCombined, Tuple({unique_visit_types}))
+)
+ENGINE = AggregatingMergeTree()
+ORDER BY (tiny_url, day)
+"""
+
+ANALYTICS_DAILY_SELECT = """
+SELECT
+    tiny_url,
+    toDate(timestamp) AS day,
+    count() AS visits,
+    uniqCombinedState(({unique_visit})) AS unique_visits
+FROM analytics
+GROUP BY tiny_url, day
+"""
+
+LEGACY_UNIQUE_VISIT = "device, operating_system, browser, ip_address"
+LEGACY_UNIQUE_VISIT_TYPES = "String, String, String, String"
+UNIQUE_VISIT = (
+    "CAST(device AS String), CAST(operating_system AS String),"
+    " CAST(browser AS String), ip_address"
+)
+UNIQUE_VISIT_TYPES = "String, String, String, IPv6"
+
+
+def create_rollup(client: Client, unique_visit: str, unique_visit_types: str):
+    """Create the daily rollup of ``analytics`` and aggregate existing rows into it.
+
+    A materialized view aggregates every row inserted from then on, whatever
+    its timestamp, and the rows which existed before are aggregated once.
+    Every row is counted exactly once as long as nothing inserts into
+    ``analytics`` in between, which holds for :func:`create_tables_exclusively`
+    run before the consumer starts.
+    """
+    select = ANALYTICS_DAILY_SELECT.format(unique_visit=unique_visit)
+    client.command(ANALYTICS_DAILY_TABLE.format(unique_visit_types=unique_visit_types))
+    client.command(
+        f"CREATE MATERIALIZED VIEW analytics_daily_mv TO analytics_daily AS {select}"
+    )
+    client.command(f"INSERT INTO analytics_daily {select}")
+
+
+def create_legacy_tables(client: Client):
+    client.command(LEGACY_ANALYTICS_TABLE)
+    if not client.command("EXISTS TABLE analytics_daily"):
+        create_rollup(client, LEGACY_UNIQUE_VISIT, LEGACY_UNIQUE_VISIT_TYPES)
+
+
+def analytics_column_type(client: Client, column: str) -> str:
+    return client.command(
+        "SELECT type FROM system.columns WHERE database = currentDatabase()"
+        f" AND table = 'analytics' AND name = '{column}'"
+    )
+
+
+def migrate_analytics_columns(client: Client):
+    """Copy ``analytics`` into a partitioned table with compact column types.
+
+    The copy replaces the table in one ``EXCHANGE``, the old one is kept as
+    ``analytics_legacy`` until it's dropped by hand. The rollup depends on
+    types of the columns, it's built again from the new table. Every step
+    may be repeated if a previous attempt failed.
+    """
+    if analytics_column_type(client, "ip_address") != "IPv6":
+        client.command("DROP TABLE IF EXISTS analytics_migration")
+        client.command(ANALYTICS_TABLE.format(name="analytics_migration"))
+        client.command(
+            """
+            INSERT INTO analytics_migration
+            SELECT
+                host,
+                path,
+                tiny_url,
+                timestamp,
+                toIPv6OrDefault(
+                    if(
+                        isIPv4String(ip_address),
+                        concat('::ffff:', ip_address),
+                        ip_address
+                    )
+                ),
+                location,
+                device,
+                operating_system,
+                browser,
+                is_mobile,
+                is_bot
+            FROM analytics
+            """
+        )
+        client.command("EXCHANGE TABLES analytics_migration AND analytics")
+    if client.command("EXISTS TABLE analytics_migration"):
+        client.command("RENAME TABLE analytics_migration TO analytics_legacy")
+    client.command("DROP VIEW IF EXISTS analytics_daily_mv")
+    client.command("DROP TABLE IF EXISTS analytics_daily")
+    create_rollup(client, UNIQUE_VISIT, UNIQUE_VISIT_TYPES)
+
+
+def create_latest_tables(client: Client):
+    client.command(ANALYTICS_TABLE.format(name="analytics"))
+    create_rollup(client, UNIQUE_VISIT, UNIQUE_VISIT_TYPES)
+
+
+# Applied in order, each at most once, the applied ones are recorded in
+# ``schema_migrations``.
+MIGRATIONS: list[tuple[int, Callable[[Client], None]]] = [
+    (1, create_legacy_tables),
+    (2, migrate_analytics_columns),
+]
+
+
+def set_ttl(client: Client, ttl_days: int | None):
+    """Make ``analytics`` drop rows older than ``ttl_days``, keep them with ``None``.
+
+    The rollup keeps daily stats of rows removed by the TTL.
+    """
+    create_table_query = client.command(
+        "SELECT create_table_query FROM system.tables"
+        " WHERE database = currentDatabase() AND name = 'analytics'"
+    )
+    current_ttl = " TTL " in create_table_query
+    if ttl_days is None:
+        if current_ttl:
+            client.command("ALTER TABLE analytics REMOVE TTL")
+    elif f"toIntervalDay({ttl_days})" not in create_table_query:
+        client.command(
+            f"ALTER TABLE analytics MODIFY TTL timestamp + INTERVAL {ttl_days} DAY"
+        )
+
+
+def create_tables(client: Client, ttl_days: int | None = None):
+    """Bring analytics tables to the latest schema.
+
+    Migrations copy whole tables, they have to run before records are
+    consumed so that no insert goes into a table which is being replaced.
+    """
+    client.command(MIGRATIONS_TABLE)
+    applied = client.command("SELECT max(version) FROM schema_migrations")
+    if not applied and not client.command("EXISTS TABLE analytics"):
+        create_latest_tables(client)
+        applied = MIGRATIONS[-1][0]
+        client.command(f"INSERT INTO schema_migrations (version) VALUES ({applied})")
+    for version, migrate in MIGRATIONS:
+        if version <= applied:
+            continue
+        logger.info("Applying analytics schema migration %s.", version)
+        migrate(client)
+        client.command(f"INSERT INTO schema_migrations (version) VALUES ({version})")
+    set_ttl(client, ttl_days)
+
+
+async def create_tables_exclusively(
+    redis: aioredis.Redis,
+    client: Client,
+    ttl_days: int | None = None,
+    lock_timeout: float | None = None,
+):
+    """Run :func:`create_tables` in one replica at a time.
+
+    Replicas starting together would otherwise all create tables of a new
+    database or copy the same table, the others wait for the lock and find
+    the schema up to date.
+    """
+    async with redis.lock("analytics:schema", timeout=lock_timeout):
+        create_tables(client, ttl_days)
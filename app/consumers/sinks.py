@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Sequence
+
+from clickhouse_connect.driver import Client
+
+
+class ClickHouseSink:
+    """Buffers rows and inserts them into ClickHouse in large batches.
+
+    Inserts run in an executor so the event loop never waits on ClickHouse.
+    At most ``max_pending_batches`` inserts are in flight at once, once that
+    limit is reached ``put`` blocks, which slows the Kafka loop down instead
+    of buffering without bound.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        table: str,
+        column_names: Sequence[str],
+        *,
+        max_batch_size: int = 10_000,
+        flush_interval: float = 1.0,
+        max_pending_batches: int = 2,
+        executor: Executor | None = None,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        self.client = client
+        self.table = table
+        self.column_names = tuple(column_names)
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.executor = executor
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self._rows: list[Sequence[Any]] = []
+        self._first_row_time: float | None = None
+        self._slots = asyncio.Semaphore(max_pending_batches)
+        self._inserts: set[asyncio.Task] = set()
+        self._flusher: asyncio.Task | None = None
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}({self.table})"
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def put(self, row: Sequence[Any]):
+        if not self._rows:
+            self._first_row_time = time.monotonic()
+        self._rows.append(row)
+        if len(self._rows) >= self.max_batch_size:
+            await self._dispatch()
+
+    async def flush(self):
+        """Send buffered rows and wait until every pending insert finished."""
+        if self._rows:
+            await self._dispatch()
+        inserts = list(self._inserts)
+        self._inserts.clear()
+        await asyncio.gather(*inserts)
+
+    async def _dispatch(self):
+        await self._slots.acquire()
+        rows, self._rows = self._rows, []
+        if not rows:
+            self._slots.release()
+            return
+        task = asyncio.create_task(self._insert(rows))
+        self._inserts.add(task)
+        task.add_done_callback(self._forget_successful)
+
+    def _forget_successful(self, task: asyncio.Task):
+        # Failed inserts are kept so the next flush re-raises their error.
+        if not task.cancelled() and task.exception() is None:
+            self._inserts.discard(task)
+
+    async def _insert(self, rows: list[Sequence[Any]]):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self.executor,
+                partial(self.client.insert, self.table, rows, self.column_names),
+            )
+        except Exception:
+            self.logger.exception(
+                "Failed to insert %s rows into %s, requeueing them.",
+                len(rows),
+                self.table,
+            )
+            self._rows[:0] = rows
+            raise
+        finally:
+            self._slots.release()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if (
+                self._rows
+                and time.monotonic() - self._first_row_time >= self.flush_interval
+            ):
+                await self._dispatch()
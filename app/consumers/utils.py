@@ -1,7 +1,60 @@
+from collections import deque
 from dataclasses import dataclass
-from typing import Any, TypeVar
+from functools import cached_property
+from typing import Any, Iterable, Sequence, TypeVar
+from urllib.parse import SplitResult, urlsplit
 
-from aiokafka import ConsumerRecord
+from aiokafka import ConsumerRecord, TopicPartition
+
+
+class URLEvent:
+    """Fields of a URL event read by consumers.
+
+    The API validated them before they were sent, so they aren't validated
+    again. The URL is split only once its parts are accessed.
+    """
+
+    __slots__ = ("tiny_url", "url", "ip_address", "user_agent", "_parts")
+
+    def __init__(
+        self,
+        tiny_url: str,
+        url: str,
+        ip_address: str | None = None,
+        user_agent: str | None = None,
+    ) -> None:
+        self.tiny_url = tiny_url
+        self.url = url
+        self.ip_address = ip_address
+        self.user_agent = user_agent
+        self._parts: SplitResult | None = None
+
+    @classmethod
+    def from_value(cls, value: dict[str, Any]) -> "URLEvent":
+        return cls(
+            value["tiny_url"],
+            value["url"],
+            value.get("ip_address"),
+            value.get("user_agent"),
+        )
+
+    @property
+    def parts(self) -> SplitResult:
+        if self._parts is None:
+            self._parts = urlsplit(self.url)
+        return self._parts
+
+    @property
+    def host(self) -> str:
+        """Host as written in the URL, without credentials and port."""
+        host = self.parts.netloc.rpartition("@")[2]
+        if host.startswith("["):
+            return host[: host.index("]") + 1]
+        return host.partition(":")[0]
+
+    @property
+    def path(self) -> str:
+        return self.parts.path
 
 
 @dataclass(frozen=True)
@@ -13,6 +66,55 @@ class ParsedRecord:
     timestamp_type: int
     key: Any
     value: dict
+    headers: Sequence[tuple[str, bytes]] = ()
+
+    @cached_property
+    def event(self) -> URLEvent:
+        """View of the value, created once and shared by every handler."""
+        return URLEvent.from_value(self.value)
 
 
 RecordT = TypeVar("RecordT", ParsedRecord, ConsumerRecord)
+
+
+class OffsetTracker:
+    """Keeps track of in-flight offsets of every partition.
+
+    Records may finish out of order, an offset only becomes committable once
+    every record before it on the same partition has finished as well.
+    """
+
+    def __init__(self) -> None:
+        self._in_flight: dict[TopicPartition, deque[int]] = {}
+        self._finished: dict[TopicPartition, set[int]] = {}
+        self._committable: dict[TopicPartition, int] = {}
+
+    def begin(self, partition: TopicPartition, offset: int):
+        self._in_flight.setdefault(partition, deque()).append(offset)
+        self._finished.setdefault(partition, set())
+
+    def finish(self, partition: TopicPartition, offset: int):
+        if partition not in self._in_flight:
+            return
+        in_flight, finished = self._in_flight[partition], self._finished[partition]
+        finished.add(offset)
+        while in_flight and in_flight[0] in finished:
+            finished.remove(in_flight[0])
+            self._committable[partition] = in_flight.popleft() + 1
+
+    def pop_committable(self) -> dict[TopicPartition, int]:
+        committable, self._committable = self._committable, {}
+        return committable
+
+    def restore(self, committable: dict[TopicPartition, int]):
+        """Return offsets popped for a commit which failed."""
+        for partition, offset in committable.items():
+            self._committable[partition] = max(
+                offset, self._committable.get(partition, offset)
+            )
+
+    def forget(self, partitions: Iterable[TopicPartition]):
+        for partition in partitions:
+            self._in_flight.pop(partition, None)
+            self._finished.pop(partition, None)
+            self._committable.pop(partition, None)
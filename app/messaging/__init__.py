@@ -1,10 +1,20 @@
-from typing import Any
+import asyncio
+from functools import partial
+from typing import Any, Iterable, Literal
 
 import orjson
 from aiokafka import AIOKafkaProducer
 from bson import ObjectId
 from pydantic import BaseModel
 
+from app.config import Configuration, configuration
+from app.messaging.encoding import (
+    COMPACT_FIELDS,
+    COMPACT_V1,
+    ENCODING_HEADER,
+    encode_compact,
+)
+
 
 def __make_topic(model: BaseModel, action: str):
     return f"{model.__class__.__name__}.{action}"
@@ -16,15 +26,80 @@ def _default_objectid(obj):
     raise TypeError()
 
 
+def producer_factory(config: Configuration) -> partial[AIOKafkaProducer]:
+    """Producer which batches messages as configured, created at startup."""
+    options = {}
+    if config.kafka_partitioner is not None:
+        options["partitioner"] = config.kafka_partitioner
+    return partial(
+        AIOKafkaProducer,
+        bootstrap_servers=f"{config.kafka_dsn.host}:{config.kafka_dsn.port}",
+        linger_ms=config.kafka_linger_ms,
+        max_batch_size=config.kafka_max_batch_size,
+        compression_type=config.kafka_compression_type,
+        enable_idempotence=config.kafka_enable_idempotence,
+        **options,
+    )
+
+
+def message_key(data: BaseModel) -> bytes | None:
+    """Messages of one link share a key, so they land on the same partition."""
+    tiny_url = getattr(data, "tiny_url", None)
+    return tiny_url.encode() if tiny_url is not None else None
+
+
+def encode_message(
+    data: BaseModel,
+    additional_data: dict[str, Any] | None = None,
+    encoding: Literal["json", "compact"] | None = None,
+) -> tuple[bytes, list[tuple[str, bytes]]]:
+    """Serialize a message, return it together with headers naming its format."""
+    if (encoding or configuration.kafka_message_encoding) == "compact":
+        values = {field: getattr(data, field, None) for field in COMPACT_FIELDS}
+        if additional_data:
+            values.update(additional_data)
+        return encode_compact(values), [(ENCODING_HEADER, COMPACT_V1)]
+    data: dict = data.dict()
+    if additional_data:
+        data.update(additional_data)
+    return orjson.dumps(data, default=_default_objectid), []
+
+
 async def send_message(
     producer: AIOKafkaProducer,
     action: str,
     data: BaseModel,
     *,
     additional_data: dict[str, Any] | None = None,
+    encoding: Literal["json", "compact"] | None = None,
 ):
     topic = __make_topic(data, action)
-    data: dict = data.dict()
-    if additional_data:
-        data.update(additional_data)
-    await producer.send(topic, orjson.dumps(data, default=_default_objectid))
+    value, headers = encode_message(data, additional_data, encoding)
+    await producer.send(topic, value, key=message_key(data), headers=headers)
+
+
+async def send_many(
+    producer: AIOKafkaProducer,
+    action: str,
+    data: Iterable[BaseModel],
+    *,
+    additional_data: dict[str, Any] | None = None,
+    encoding: Literal["json", "compact"] | None = None,
+):
+    """Send messages without waiting for each, then wait for all of them.
+
+    ``send`` only appends a message to a batch of its partition, which the
+    producer sends with others once it's full or ``linger_ms`` passed.
+    """
+    deliveries = []
+    for item in data:
+        value, headers = encode_message(item, additional_data, encoding)
+        deliveries.append(
+            await producer.send(
+                __make_topic(item, action),
+                value,
+                key=message_key(item),
+                headers=headers,
+            )
+        )
+    await asyncio.gather(*deliveries)
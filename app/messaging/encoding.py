@@ -0,0 +1,69 @@
+import struct
+from typing import Any, Sequence
+
+import orjson
+
+ENCODING_HEADER = "encoding"
+COMPACT_V1 = b"compact/1"
+
+# Only fields consumers read are sent in the compact format, each as UTF-8
+# preceded by its length, the largest length stands for a missing value.
+# Longer values are truncated to fit below it.
+COMPACT_FIELDS = ("tiny_url", "url", "ip_address", "user_agent")
+_COMPACT_V1_LENGTHS = struct.Struct("!HIHH")
+_MISSING = (0xFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFF)
+
+HeadersT = Sequence[tuple[str, bytes]]
+
+
+def _truncate(value: bytes, limit: int) -> bytes:
+    if len(value) <= limit:
+        return value
+    # Cut at a character boundary, so that the value still decodes.
+    return value[:limit].decode(errors="ignore").encode()
+
+
+def encode_compact(values: dict[str, Any]) -> bytes:
+    encoded = [
+        None
+        if values.get(field) is None
+        else _truncate(str(values[field]).encode(), missing - 1)
+        for field, missing in zip(COMPACT_FIELDS, _MISSING)
+    ]
+    return _COMPACT_V1_LENGTHS.pack(
+        *(
+            missing if value is None else len(value)
+            for value, missing in zip(encoded, _MISSING)
+        )
+    ) + b"".join(value for value in encoded if value is not None)
+
+
+def decode_compact(payload: bytes) -> dict[str, Any]:
+    values = {}
+    position = _COMPACT_V1_LENGTHS.size
+    for field, length, missing in zip(
+        COMPACT_FIELDS, _COMPACT_V1_LENGTHS.unpack_from(payload), _MISSING
+    ):
+        if length == missing:
+            values[field] = None
+            continue
+        values[field] = payload[position : position + length].decode()
+        position += length
+    return values
+
+
+def encoding_of(headers: HeadersT | None) -> bytes | None:
+    for key, value in headers or ():
+        if key == ENCODING_HEADER:
+            return value
+    return None
+
+
+def decode(value: bytes, headers: HeadersT | None = None) -> dict[str, Any]:
+    """Decode a message in the format named by its headers, JSON without one."""
+    encoding = encoding_of(headers)
+    if encoding is None:
+        return orjson.loads(value)
+    if encoding == COMPACT_V1:
+        return decode_compact(value)
+    raise ValueError(f"Unsupported message encoding {encoding!r}.")
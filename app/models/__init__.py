@@ -4,10 +4,22 @@ from functools import partial
 from bson import ObjectId
 from nanoid import generate
 from pydantic import AnyHttpUrl, BaseConfig, BaseModel, Field, NonNegativeInt
+from pymongo import ASCENDING
 
 from app.app import TypedApp
 from app.types import TinyURL
 
+# Fields of links read by redirects, in the order of the index covering them.
+REDIRECT_FIELDS = (
+    "tiny_url",
+    "url",
+    "max_redirects",
+    "time_to_live",
+    "creation_time",
+    "_id",
+)
+REDIRECT_INDEX = [(field, ASCENDING) for field in REDIRECT_FIELDS]
+
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -25,6 +37,12 @@ class PyObjectId(ObjectId):
         field_schema.update(type="string")
 
 
+def now() -> datetime:
+    """Current time at the millisecond precision of dates stored by MongoDB."""
+    current = datetime.now()
+    return current.replace(microsecond=current.microsecond // 1000 * 1000)
+
+
 class ModelConfig(BaseConfig):
     arbitrary_types_allowed = True
     json_encoders = {ObjectId: str}
@@ -36,17 +54,19 @@ class URL(BaseModel):
     url: AnyHttpUrl = Field(...)
     max_redirects: NonNegativeInt | None = None
     time_to_live: NonNegativeInt | None = None
-    creation_time: datetime = Field(default_factory=datetime.now)
+    creation_time: datetime = Field(default_factory=now)
     last_visit_time: datetime | None = Field(default=None)
     last_modified_time: datetime | None = Field(default=None)
 
+    @property
+    def expires_at(self) -> datetime | None:
+        if self.time_to_live is None:
+            return None
+        return self.creation_time + timedelta(hours=self.time_to_live)
+
     @property
     def is_expired(self):
-        return (
-            self.time_to_live is not None
-            and timedelta(hours=self.time_to_live)
-            <= datetime.now() - self.creation_time
-        )
+        return self.expires_at is not None and self.expires_at <= datetime.now()
 
     class Config(ModelConfig):
         pass
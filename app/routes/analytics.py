@@ -1,13 +1,65 @@
-from typing import Iterable
+import asyncio
+from datetime import date, timedelta
+from functools import partial
+from typing import Any
 
+import orjson
+from clickhouse_connect.driver import Client
 from fastapi import APIRouter, Depends
 from fastapi_cbv import endpoint, view
 
-from app.app import TypedRequest
+from app.app import TypedApp, TypedRequest
 from app.schemas.analytics import AnalyticsStatsItem, AnalyticsStatsRequest
 
 router = APIRouter(prefix="/analytics", tags=["Metrics", "Analytics"])
 
+# Reads the daily rollup, so the cost of a query depends on the number of
+# days instead of the number of visits.
+STATS_QUERY = """
+    SELECT sum(visits) AS visits, day, uniqCombinedMerge(unique_visits) AS unique_visits
+    FROM analytics_daily
+    WHERE tiny_url = {tiny_url_id:String}
+        AND day >= {start_date:Date}
+        AND day <= {end_date:Date}
+    GROUP BY day
+    ORDER BY day
+"""
+
+
+def query_stats(
+    client: Client, tiny_url: str, start_date: date, end_date: date
+) -> list[dict[str, Any]]:
+    result = client.query(
+        STATS_QUERY,
+        parameters={
+            "tiny_url_id": tiny_url,
+            "start_date": start_date,
+            "end_date": end_date,
+        },
+    )
+    return list(result.named_results())
+
+
+async def cached_stats(
+    app: TypedApp,
+    tiny_url: str,
+    start_date: date,
+    end_date: date,
+    ttl: timedelta,
+) -> list[dict[str, Any]]:
+    key = f"analytics:{tiny_url}:{start_date.isoformat()}:{end_date.isoformat()}"
+    cached = await app.redis.get(key)
+    if cached is not None:
+        return orjson.loads(cached)
+    # The ClickHouse client blocks, queries run in a bounded pool of threads
+    # so that a slow one doesn't stop redirects served by this worker.
+    stats = await asyncio.get_running_loop().run_in_executor(
+        app.analytics_executor,
+        partial(query_stats, app.clickhouse_client, tiny_url, start_date, end_date),
+    )
+    await app.redis.set(key, orjson.dumps(stats), ex=ttl)
+    return stats
+
 
 @view(router, path="/tiny_url/{tiny_url_id}")
 class TinyUrlAnalyticsView:
@@ -17,20 +69,37 @@ class TinyUrlAnalyticsView:
         path="/stats",
         response_model=list[AnalyticsStatsItem],
     )
-    async def stats(self, tiny_url_id: str, request: TypedRequest, params: AnalyticsStatsRequest = Depends()):
-        params = params.dict()
-        params["tiny_url_id"] = tiny_url_id
-        r = request.app.clickhouse_client.query(
-            """
-                SELECT count(*) as visits, toDate(timestamp) as day, uniqCombined((device, operating_system, browser, ip_address)) as unique_visits 
-                FROM analytics 
-                WHERE tiny_url = {tiny_url_id:String} 
-                    AND day >= {start_date: DateTime}
-                    AND day <= {end_date: DateTime}
-                GROUP BY day
-                ORDER BY day
-            """,
-            parameters=params,
-        )
-        return list(r.named_results())
-
+    async def stats(
+        self,
+        tiny_url_id: str,
+        request: TypedRequest,
+        params: AnalyticsStatsRequest = Depends(),
+    ):
+        # Days before the recent ones are settled and cached for a long time,
+        # the recent ones are queried again once their short lived entry
+        # expires. Neither is cached forever, so a correction of the rollup
+        # shows up eventually.
+        config = request.app.config
+        recent_start = date.today() - timedelta(days=config.analytics_recent_days - 1)
+        ranges = []
+        if params.start_date < recent_start:
+            ranges.append(
+                cached_stats(
+                    request.app,
+                    tiny_url_id,
+                    params.start_date,
+                    min(params.end_date, recent_start - timedelta(days=1)),
+                    timedelta(seconds=config.analytics_cache_ttl_seconds),
+                )
+            )
+        if params.end_date >= recent_start:
+            ranges.append(
+                cached_stats(
+                    request.app,
+                    tiny_url_id,
+                    max(params.start_date, recent_start),
+                    params.end_date,
+                    timedelta(seconds=config.analytics_recent_cache_ttl_seconds),
+                )
+            )
+        return [item for stats in await asyncio.gather(*ranges) for item in stats]
@@ -20,3 +20,8 @@ async def get_metrics(
         .to_list(length=50)
     )
     return [Host(**metrics) for metrics in r]
+
+
+@router.get("/cache")
+async def get_cache_metrics(request: TypedRequest):
+    return request.app.local_cache.info()
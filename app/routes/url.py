@@ -1,34 +1,188 @@
+import asyncio
+import time
+from contextlib import suppress
 from datetime import datetime, timedelta
+from typing import Sequence
 
 import orjson
-from fastapi import APIRouter, BackgroundTasks, HTTPException, status, Header
-from fastapi.responses import RedirectResponse
+from aioredis.exceptions import LockError
+from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi_cbv.endpoint import endpoint
 from fastapi_cbv.view import view
 from pydantic import conlist
-from pymongo.results import InsertOneResult, InsertManyResult
+from pymongo.errors import BulkWriteError
 
 from app.app import TypedApp, TypedRequest
-from app.messaging import send_message
-from app.models import URL
-from app.schemas import CreateTinyURL
+from app.cache import MISSING, capped_ttl
+from app.messaging import send_many, send_message
+from app.models import REDIRECT_FIELDS, URL
+from app.schemas import BulkCreateError, BulkCreateResponse, CreateTinyURL
 from app.types import TinyURL
 
 router = APIRouter(prefix="/url", tags=["URLs"])
 
 
-async def update_cache(
-    app: TypedApp, tiny_url: str, url: str, max_reads: int | None = None
+def expiry_timestamp(url: URL) -> int | None:
+    # Rounded down, a link is rather dropped from caches a moment too early.
+    return None if url.expires_at is None else int(url.expires_at.timestamp())
+
+
+def cache_entry(url: URL) -> bytes:
+    if url.max_redirects == 0:
+        return MISSING
+    return orjson.dumps([url.url, url.max_redirects, expiry_timestamp(url)])
+
+
+def cache_locally(
+    app: TypedApp,
+    tiny_url: str,
+    url: str,
+    max_reads: int | None,
+    expires_at: float | None = None,
 ):
+    # Links with a redirect limit have to be decremented on every hit, so only
+    # unlimited ones may be served from the in-process cache. It's filled by
+    # redirects only, links which are written but not read don't evict it.
+    ttl = capped_ttl(app.config.local_cache_ttl_seconds, expires_at)
+    if max_reads is None and ttl > 0:
+        app.local_cache.set(tiny_url, url, ttl)
+    else:
+        app.local_cache.invalidate(tiny_url)
+
+
+async def update_cache_many(app: TypedApp, urls: Sequence[URL]):
+    """Cache all ``urls`` in a single round trip to Redis."""
+    async with app.redis.pipeline(transaction=False) as pipeline:
+        for url in urls:
+            expires_at = expiry_timestamp(url)
+            ttl = capped_ttl(app.config.cache_ttl * 60, expires_at)
+            if ttl >= 0.001:
+                pipeline.set(url.tiny_url, cache_entry(url), px=int(ttl * 1000))
+        await pipeline.execute()
+
+
+async def update_cache(app: TypedApp, url: URL):
+    await update_cache_many(app, [url])
+
+
+async def publish_created(app: TypedApp, urls: Sequence[URL]):
+    await asyncio.gather(
+        update_cache_many(app, urls), send_many(app.producer, "create", urls)
+    )
+
+
+async def find_redirect(app: TypedApp, tiny_url: str) -> URL | None:
+    """Read fields needed by a redirect from the covering index only.
+
+    MongoDB prefers plans which don't fetch documents, and documents were
+    validated when they were created, so the model is built without
+    validation.
+    """
+    document = await app.database["tinyurl"].find_one(
+        {"tiny_url": tiny_url}, dict.fromkeys(REDIRECT_FIELDS, 1)
+    )
+    if document is None:
+        return None
+    return URL.construct(id=document.pop("_id"), **document)
+
+
+async def read_cache(app: TypedApp, tiny_url: str) -> bytes | None:
+    # Redirects of limited links are consumed by the script atomically.
+    return await app.read_and_decrement(
+        keys=[tiny_url],
+        args=[app.config.cache_ttl * 60_000, app.config.cache_max_ttl * 60_000],
+    )
+
+
+def cached_url(app: TypedApp, tiny_url: str, cached: bytes) -> URL | None:
+    """Link of an entry read from Redis, ``None`` for links cached as missing."""
+    if cached == MISSING:
+        return None
+    url, max_redirects, *expiry = orjson.loads(cached)
+    if max_redirects is None:
+        cache_locally(app, tiny_url, url, None, expiry[0] if expiry else None)
+    return URL.construct(url=url, max_redirects=max_redirects, tiny_url=tiny_url)
+
+
+async def load_url(app: TypedApp, tiny_url: str) -> URL | None:
+    """Read a link from MongoDB and cache it, or cache that it's missing."""
+    url = await find_redirect(app, tiny_url)
+    if url is None or url.max_redirects == 0 or url.is_expired:
+        await cache_missing(app, tiny_url)
+        return None
+    if url.max_redirects is None:
+        await update_cache(app, url)
+        cache_locally(app, tiny_url, url.url, None, expiry_timestamp(url))
+    else:
+        # The request which loads a limited link uses one of its redirects.
+        await update_cache(
+            app, url.copy(update={"max_redirects": url.max_redirects - 1})
+        )
+    return url
+
+
+async def fill_cache(app: TypedApp, tiny_url: str) -> URL | None:
+    """Load a link missing from the cache, locking it across workers if configured.
+
+    The worker which locks the link loads it, the others poll the cache for
+    the entry it stores and load the link themselves only once the lock is
+    gone without one.
+    """
+    timeout = app.config.cache_fill_lock_seconds
+    if timeout is None:
+        return await load_url(app, tiny_url)
+    lock = app.redis.lock(f"{tiny_url}:fill", timeout=timeout)
+    if await lock.acquire(blocking=False):
+        try:
+            return await load_url(app, tiny_url)
+        finally:
+            with suppress(LockError):
+                await lock.release()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(app.config.cache_fill_poll_seconds)
+        cached = await read_cache(app, tiny_url)
+        if cached:
+            return cached_url(app, tiny_url, cached)
+        if not await lock.locked():
+            break
+    return await load_url(app, tiny_url)
+
+
+async def cache_missing(app: TypedApp, tiny_url: str):
     await app.redis.set(
-        tiny_url,
-        orjson.dumps([url, max_reads]),
-        ex=timedelta(minutes=app.config.cache_ttl),
+        tiny_url, MISSING, ex=timedelta(seconds=app.config.missing_cache_ttl_seconds)
     )
 
 
-async def remove_from_cache(app: TypedApp, tiny_url: str):
-    await app.redis.delete(tiny_url)
+def not_found() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="This tiny URL doesn't exist.",
+    )
+
+
+def redirect_from_cache(
+    request: TypedRequest,
+    background_tasks: BackgroundTasks,
+    tiny_url: str,
+    url: str,
+    max_redirects: int | None,
+    user_agent: str | None,
+):
+    background_tasks.add_task(
+        send_message,
+        request.app.producer,
+        "read",
+        URL.construct(url=url, max_redirects=max_redirects, tiny_url=tiny_url),
+        additional_data={
+            "user_agent": user_agent,
+            "ip_address": request.client.host,
+        },
+    )
+    return RedirectResponse(url=url)
 
 
 @view(router)
@@ -40,44 +194,61 @@ class TinyUrlView:
         background_tasks: BackgroundTasks,
         data: CreateTinyURL,
     ):
+        # The document is stored exactly as the model is, so it's returned
+        # without reading it back.
         url = URL(**data.dict())
-        result: InsertOneResult = await request.app.database["tinyurl"].insert_one(
-            url.dict()
-        )
-        background_tasks.add_task(
-            update_cache, request.app, url.tiny_url, url.url, url.max_redirects
-        )
-        url = await request.app.database["tinyurl"].find_one(
-            {"_id": result.inserted_id}
-        )
-        url = URL(**url)
+        await request.app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+        # Added before responding, the link may be followed right away.
+        await request.app.url_filter.add([url.tiny_url])
+        background_tasks.add_task(update_cache, request.app, url)
         background_tasks.add_task(send_message, request.app.producer, "create", url)
         return url
 
-    @endpoint(methods=["POST"], path="bulk", status_code=status.HTTP_201_CREATED)
+    @endpoint(
+        methods=["POST"],
+        path="bulk",
+        status_code=status.HTTP_201_CREATED,
+        response_model=list[URL],
+        responses={
+            status.HTTP_207_MULTI_STATUS: {
+                "model": BulkCreateResponse,
+                "description": "Some of the URLs couldn't be created.",
+            }
+        },
+    )
     async def bulk_create(
         self,
         request: TypedRequest,
         background_tasks: BackgroundTasks,
         data: conlist(CreateTinyURL, min_items=1, max_items=2**12),
     ):
-        urls = []
-        for _url in data:
-            url = URL(**_url.dict())
-            background_tasks.add_task(
-                update_cache, request.app, url.tiny_url, url.url, url.max_redirects
+        models = [URL(**_url.dict()) for _url in data]
+        errors = []
+        try:
+            await request.app.database["tinyurl"].insert_many(
+                [url.dict(by_alias=True) for url in models], ordered=False
             )
-            background_tasks.add_task(send_message, request.app.producer, "create", url)
-            urls.append(url.dict())
-        r: InsertManyResult = await request.app.database["tinyurl"].insert_many(
-            urls, ordered=False
-        )
-        r = (
-            await request.app.database["tinyurl"]
-            .find({"_id": {"$in": [_ for _ in r.inserted_ids]}})
-            .to_list(length=2**12)
+        except BulkWriteError as exc:
+            # Unordered inserts store every document but the failed ones.
+            errors = [
+                BulkCreateError(index=error["index"], detail=error["errmsg"])
+                for error in exc.details["writeErrors"]
+            ]
+        failed = {error.index for error in errors}
+        created = [url for index, url in enumerate(models) if index not in failed]
+        if created:
+            await request.app.url_filter.add(url.tiny_url for url in created)
+            background_tasks.add_task(publish_created, request.app, created)
+        if not errors:
+            return created
+        # Only partial failures are answered with errors, so clients of the
+        # plain list keep working. Background tasks are attached to it too.
+        return JSONResponse(
+            status_code=status.HTTP_207_MULTI_STATUS,
+            content=jsonable_encoder(
+                BulkCreateResponse(created=created, errors=errors)
+            ),
         )
-        return [URL(**_) for _ in r]
 
     @endpoint(methods=["GET"], path="{tiny_url}", response_class=RedirectResponse)
     async def get(
@@ -87,40 +258,44 @@ class TinyUrlView:
         tiny_url: TinyURL,
         user_agent: str | None = Header(default=None),
     ):
-        url = await request.app.redis.get(tiny_url)
+        url = request.app.local_cache.get(tiny_url)
         if url:
-            url, max_redirects = orjson.loads(url)
-            if max_redirects:
-                if max_redirects == 1:
-                    background_tasks.add_task(remove_from_cache, request.app, tiny_url)
-                else:
-                    background_tasks.add_task(
-                        update_cache, request.app, tiny_url, url, max_redirects - 1
-                    )
-            background_tasks.add_task(
-                send_message,
-                request.app.producer,
-                "read",
-                URL(url=url, max_redirects=max_redirects, tiny_url=tiny_url),
-                additional_data={
-                    "user_agent": user_agent,
-                    "ip_address": request.client.host,
-                },
+            return redirect_from_cache(
+                request, background_tasks, tiny_url, url, None, user_agent
             )
-            return RedirectResponse(url=url)
-        url = await request.app.database["tinyurl"].find_one({"tiny_url": tiny_url})
-        try:
-            url = URL(**url)
-            if url.max_redirects == 0 or url.is_expired:
-                raise ValueError()
-        except (ValueError, TypeError) as exc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="This tiny URL doesn't exist.",
-            ) from exc
-        background_tasks.add_task(
-            update_cache, request.app, url.tiny_url, url.url, url.max_redirects
-        )
+        cached = await read_cache(request.app, tiny_url)
+        if cached:
+            url = cached_url(request.app, tiny_url, cached)
+            if url is None:
+                raise not_found()
+            return redirect_from_cache(
+                request,
+                background_tasks,
+                tiny_url,
+                url.url,
+                url.max_redirects,
+                user_agent,
+            )
+        # Codes which were never created are mostly rejected by the filter
+        # without querying the database.
+        if not await request.app.url_filter.might_contain(tiny_url):
+            raise not_found()
+        # Concurrent misses of a link wait for a single load of it.
+        loaded = False
+
+        async def load():
+            nonlocal loaded
+            loaded = True
+            return await fill_cache(request.app, tiny_url)
+
+        url = await request.app.cache_fills.do(tiny_url, load)
+        if url is not None and url.max_redirects is not None and not loaded:
+            # The load used one redirect of a limited link for the request
+            # which ran it, the others wait for it and consume their own.
+            cached = await read_cache(request.app, tiny_url)
+            url = cached_url(request.app, tiny_url, cached) if cached else None
+        if url is None:
+            raise not_found()
         background_tasks.add_task(send_message, request.app.producer, "read", url)
         return RedirectResponse(url=url.url)
 
@@ -136,13 +311,10 @@ class TinyUrlView:
     ):
         url = await request.app.database["tinyurl"].find_one({"tiny_url": tiny_url})
         if url is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="This tiny URL doesn't exist.",
-            )
+            raise not_found()
         url = URL(**url)
-        if not url.is_expired:
-            background_task.add_task(
-                update_cache, request.app, url.tiny_url, url.url, url.max_redirects
-            )
+        # The stored count of a limited link lags behind the cached one until
+        # consumers have caught up, so only unlimited links are cached here.
+        if not url.is_expired and url.max_redirects is None:
+            background_task.add_task(update_cache, request.app, url)
         return url
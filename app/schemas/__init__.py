@@ -1,5 +1,7 @@
 from pydantic import AnyHttpUrl, BaseModel, Field, NonNegativeInt
 
+from app.models import URL, ModelConfig
+
 
 class CreateTinyURL(BaseModel):
     url: AnyHttpUrl = Field(..., description="A URL to be shortened.")
@@ -10,3 +12,16 @@ class CreateTinyURL(BaseModel):
     time_to_live: NonNegativeInt | None = Field(
         None, description="Time to live for tiny URL in hours.", alias="ttl"
     )
+
+
+class BulkCreateError(BaseModel):
+    index: int = Field(..., description="Position of the URL in the request.")
+    detail: str
+
+
+class BulkCreateResponse(BaseModel):
+    created: list[URL] = Field(default_factory=list)
+    errors: list[BulkCreateError] = Field(default_factory=list)
+
+    class Config(ModelConfig):
+        pass
@@ -0,0 +1,614 @@
+"""Consumer throughput benchmark.
+
+Pushes a synthetic stream of ``URL.read`` and ``URL.create`` records through
+the same middleware and handlers ``python -m app.consumers`` runs. MongoDB is
+replaced with mongomock-motor unless ``--backend local`` is given, ClickHouse
+inserts are discarded and GeoIP lookups use the configured database when it
+exists. The stream is generated from a seed, ``--save`` stores it and
+``--replay`` runs a stored one again::
+
+    python -m tests.benchmarks.consumer_throughput --records 100000 --batch-size 500
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+import tracemalloc
+from base64 import b64decode, b64encode
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from ipaddress import IPv4Address, ip_address, ip_network
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator
+
+import orjson
+from aiokafka import ConsumerRecord, TopicPartition
+from bson import ObjectId
+from geoip2.database import Reader
+from kafka.partitioner.default import DefaultPartitioner
+from motor.core import Database
+
+from app.config import configuration
+from app.connections import Connections
+from app.consumers import Consumer
+from app.consumers.enrichment import initialize_worker
+from app.consumers.handlers import (
+    ANALYTICS_COLUMNS,
+    BaseHandler,
+    HandleAnalytics,
+    HandleLastVisitTime,
+    HandleMetrics,
+)
+from app.consumers.middleware import (
+    ExceptionMiddleware,
+    LoggingMiddleware,
+    OrJSONMiddleware,
+    TimingMiddleware,
+)
+from app.consumers.sinks import ClickHouseSink
+from app.consumers.utils import RecordT
+from app.messaging import send_message
+from app.messaging.encoding import HeadersT, decode
+from app.models import URL
+
+USER_AGENTS = (
+    (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36",
+        40,
+    ),
+    (
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 16_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.4 Mobile/15E148 Safari/604.1",
+        20,
+    ),
+    (
+        "Mozilla/5.0 (Linux; Android 13; SM-S908B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Mobile Safari/537.36",
+        15,
+    ),
+    (
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.4 Safari/605.1.15",
+        10,
+    ),
+    (
+        "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/112.0",
+        6,
+    ),
+    (
+        "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+        5,
+    ),
+    ("curl/7.88.1", 3),
+    (None, 1),
+)
+TINY_URL_ALPHABET = "_-0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+COUNTRIES = ("US", "DE", "PL", "GB", "FR", "JP", "BR", "IN", "NL", "CA")
+
+
+class StreamExhausted(Exception):
+    pass
+
+
+def zipf_weights(size: int, exponent: float = 1.1) -> list[float]:
+    return [1 / rank**exponent for rank in range(1, size + 1)]
+
+
+class CollectingProducer:
+    """Keeps messages produced by :func:`app.messaging.send_message`."""
+
+    def __init__(self) -> None:
+        self.messages: list[tuple[str, bytes, bytes | None, HeadersT]] = []
+
+    async def send(self, topic, value, key=None, headers=None):
+        self.messages.append((topic, value, key, tuple(headers or ())))
+
+
+@dataclass
+class SyntheticStream:
+    """Generates the same stream of records for the same seed.
+
+    Hosts and links within a host are visited with a Zipf distribution, as
+    are the /24 networks visitors come from, User-Agents follow a fixed
+    browser share.
+    """
+
+    records: int = 10_000
+    seed: int = 0
+    hosts: int = 200
+    links_per_host: int = 20
+    networks: int = 5_000
+    read_ratio: float = 0.9
+    encoding: str = "json"
+    partitions: int = 3
+    rng: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def links(self) -> list[list[URL]]:
+        created = datetime(2023, 1, 1)
+        return [
+            [
+                URL(
+                    _id=ObjectId(self.rng.randbytes(12)),
+                    tiny_url="".join(self.rng.choices(TINY_URL_ALPHABET, k=16)),
+                    url=f"https://{'www.' * (host % 3 == 0)}host-{host}.example.com/path/{link}?q={link}",
+                    creation_time=created,
+                )
+                for link in range(self.links_per_host)
+            ]
+            for host in range(self.hosts)
+        ]
+
+    def visitor_networks(self) -> list[int]:
+        networks = []
+        while len(networks) < self.networks:
+            network = self.rng.getrandbits(24) << 8
+            if IPv4Address(network).is_global:
+                networks.append(network)
+        return networks
+
+    async def generate(self) -> list[ConsumerRecord]:
+        links = self.links()
+        networks = self.visitor_networks()
+        host_weights = zipf_weights(len(links))
+        link_weights = zipf_weights(self.links_per_host)
+        network_weights = zipf_weights(len(networks))
+        user_agents, user_agent_weights = zip(*USER_AGENTS)
+
+        producer = CollectingProducer()
+        for _ in range(self.records):
+            (host,) = self.rng.choices(links, host_weights)
+            (url,) = self.rng.choices(host, link_weights)
+            if self.rng.random() >= self.read_ratio:
+                await send_message(producer, "create", url, encoding=self.encoding)
+                continue
+            (network,) = self.rng.choices(networks, network_weights)
+            (user_agent,) = self.rng.choices(user_agents, user_agent_weights)
+            await send_message(
+                producer,
+                "read",
+                url,
+                additional_data={
+                    "user_agent": user_agent,
+                    "ip_address": str(IPv4Address(network + self.rng.randrange(256))),
+                },
+                encoding=self.encoding,
+            )
+
+        offsets = Counter()
+        timestamp = int(datetime(2023, 6, 1).timestamp() * 1000)
+        records = []
+        partitions = list(range(self.partitions))
+        for topic, value, key, headers in producer.messages:
+            partition = DefaultPartitioner()(key, partitions, partitions)
+            records.append(
+                make_record(
+                    topic,
+                    partition,
+                    offsets[topic, partition],
+                    timestamp,
+                    value,
+                    key,
+                    headers,
+                )
+            )
+            offsets[topic, partition] += 1
+            timestamp += self.rng.randrange(5)
+        return records
+
+
+def make_record(
+    topic: str,
+    partition: int,
+    offset: int,
+    timestamp: int,
+    value: bytes,
+    key: bytes | None = None,
+    headers: HeadersT = (),
+) -> ConsumerRecord:
+    return ConsumerRecord(
+        topic=topic,
+        partition=partition,
+        offset=offset,
+        timestamp=timestamp,
+        timestamp_type=0,
+        key=key,
+        value=value,
+        checksum=None,
+        serialized_key_size=-1 if key is None else len(key),
+        serialized_value_size=len(value),
+        headers=headers,
+    )
+
+
+def save_records(path: Path, records: list[ConsumerRecord]):
+    with path.open("wb") as file:
+        for record in records:
+            file.write(
+                orjson.dumps(
+                    [
+                        record.topic,
+                        record.partition,
+                        record.offset,
+                        record.timestamp,
+                        b64encode(record.key).decode() if record.key else None,
+                        b64encode(record.value).decode(),
+                        [[name, value.decode()] for name, value in record.headers],
+                    ]
+                )
+                + b"\n"
+            )
+
+
+def load_records(path: Path) -> list[ConsumerRecord]:
+    with path.open("rb") as file:
+        return [
+            make_record(
+                topic,
+                partition,
+                offset,
+                timestamp,
+                b64decode(value),
+                b64decode(key) if key else None,
+                tuple((name, value.encode()) for name, value in headers),
+            )
+            for topic, partition, offset, timestamp, key, value, headers in map(
+                orjson.loads, file
+            )
+        ]
+
+
+class ReplayConsumer:
+    """Serves records the way ``AIOKafkaConsumer`` would, then stops the run."""
+
+    def __init__(self, records: list[ConsumerRecord]) -> None:
+        self.records = records
+        self.position = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, topics, listener=None):
+        pass
+
+    async def commit(self, offsets=None):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[ConsumerRecord]:
+        for record in self.records:
+            yield record
+
+    async def getmany(self, timeout_ms=0, max_records=None):
+        if self.position >= len(self.records):
+            raise StreamExhausted()
+        records = self.records[self.position : self.position + max_records]
+        self.position += len(records)
+        batches: dict[TopicPartition, list[ConsumerRecord]] = {}
+        for record in records:
+            batches.setdefault(
+                TopicPartition(record.topic, record.partition), []
+            ).append(record)
+        return batches
+
+
+class DiscardingClickHouse:
+    def __init__(self) -> None:
+        self.rows = 0
+
+    def insert(self, table, data, column_names=None):
+        self.rows += len(data)
+
+    def command(self, command):
+        pass
+
+
+class SyntheticGeoIP:
+    """Stands in for a GeoIP reader when the database isn't available."""
+
+    def country(self, address: str):
+        network = ip_network((ip_address(address), 16), strict=False)
+        return SimpleNamespace(
+            country=SimpleNamespace(
+                iso_code=COUNTRIES[int(network.network_address) % len(COUNTRIES)]
+            ),
+            traits=SimpleNamespace(network=network),
+        )
+
+
+class TimedHandler(BaseHandler):
+    """Measures the time spent in each method of the wrapped handler."""
+
+    def __init__(self, handler: BaseHandler) -> None:
+        self.handler = handler
+        self.timings: Counter[str] = Counter()
+
+    def make_declared(self, consumer):
+        super().make_declared(consumer)
+        self.handler.make_declared(consumer)
+
+    def __str__(self) -> str:
+        return str(self.handler)
+
+    async def _timed(self, method: str, *args):
+        start = time.perf_counter()
+        try:
+            return await getattr(self.handler, method)(*args)
+        finally:
+            self.timings[method] += time.perf_counter() - start
+
+    async def __call__(self, record: RecordT) -> Any:
+        return await self._timed("__call__", record)
+
+    async def handle_batch(self, records: list[RecordT]) -> Any:
+        return await self._timed("handle_batch", records)
+
+    async def flush(self, committed: dict[TopicPartition, int] | None = None):
+        return await self._timed("flush", committed)
+
+
+@dataclass
+class BenchmarkReport:
+    records: int
+    elapsed: float
+    handlers: dict[str, dict[str, float]]
+    analytics_rows: int
+    allocations: dict[str, float] | None = None
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.elapsed
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "records": self.records,
+            "elapsed_seconds": self.elapsed,
+            "records_per_second": self.records_per_second,
+            "handlers": self.handlers,
+            "analytics_rows": self.analytics_rows,
+            "allocations": self.allocations,
+        }
+
+    def print(self):
+        print(
+            f"{self.records} records in {self.elapsed:.3f} s,"
+            f" {self.records_per_second:.1f} records/s,"
+            f" {self.analytics_rows} analytics rows"
+        )
+        # Handlers of a record run concurrently, their shares may add up to
+        # more than the whole run.
+        print(f"{'handler':<24}{'method':<16}{'total [s]':>12}{'share':>8}")
+        for handler, timings in self.handlers.items():
+            for method, seconds in timings.items():
+                print(
+                    f"{handler:<24}{method:<16}{seconds:>12.3f}"
+                    f"{seconds / self.elapsed:>8.1%}"
+                )
+        if self.allocations is not None:
+            print(
+                f"allocations: {self.allocations['blocks_per_record']:.1f} blocks"
+                f" and {self.allocations['bytes_per_record']:.0f} B per record"
+                f" retained, {self.allocations['peak_bytes'] / 2**20:.1f} MiB peak"
+            )
+
+
+async def open_database(backend: str) -> Database:
+    if backend == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+
+        return AsyncMongoMockClient()["benchmark"]
+    client = Connections(configuration).mongo
+    await client.drop_database("benchmark")
+    return client["benchmark"]
+
+
+async def seed_links(database: Database, records: list[ConsumerRecord]):
+    """Insert every link the records refer to, as the API would have."""
+    links = {}
+    for record in records:
+        url = URL(**decode(record.value, record.headers))
+        links[url.tiny_url] = url.dict()
+    await database["tinyurl"].insert_many(list(links.values()))
+
+
+async def run_benchmark(
+    records: list[ConsumerRecord],
+    options: argparse.Namespace,
+    logger: logging.Logger,
+    *,
+    trace_allocations: bool = False,
+) -> BenchmarkReport:
+    database = await open_database(options.backend)
+    await seed_links(database, records)
+    clickhouse_client = DiscardingClickHouse()
+    analytics_sink = ClickHouseSink(
+        clickhouse_client,
+        "analytics",
+        ANALYTICS_COLUMNS,
+        max_batch_size=configuration.analytics_batch_size,
+        flush_interval=configuration.analytics_flush_interval_seconds,
+        max_pending_batches=configuration.analytics_max_pending_batches,
+        logger=logger,
+    )
+    geoip_database = Path(options.geoip_database)
+    ip_reader = (
+        Reader(str(geoip_database)) if geoip_database.exists() else SyntheticGeoIP()
+    )
+    enrichment_executor = None
+    if options.enrichment_processes and geoip_database.exists():
+        enrichment_executor = ProcessPoolExecutor(
+            max_workers=options.enrichment_processes,
+            initializer=initialize_worker,
+            initargs=(str(geoip_database),),
+        )
+
+    consumer = Consumer(
+        bootstrap_servers=None,
+        client_id="benchmark",
+        logger=logger,
+        group_id="benchmark",
+        concurrency=options.concurrency,
+        batch_size=options.batch_size,
+        batch_timeout_ms=0,
+        commit_interval=configuration.consumer_commit_interval_seconds,
+        services={
+            "tinyurl_collection": database["tinyurl"],
+            "host_metrics_collection": database["host_metrics"],
+            "path_metrics_collection": database["path_metrics"],
+            "clickhouse_client": clickhouse_client,
+            "analytics_sink": analytics_sink,
+            "ip_reader": ip_reader,
+            "enrichment_executor": enrichment_executor,
+        },
+    )
+    consumer.consumer = partial(ReplayConsumer, records)
+    consumer.declare_hook("startup", analytics_sink.start)
+    consumer.declare_hook("shutdown", analytics_sink.close)
+
+    consumer.declare_middleware(OrJSONMiddleware())
+    consumer.declare_middleware(ExceptionMiddleware(logger))
+    consumer.declare_middleware(TimingMiddleware(logger))
+    consumer.declare_middleware(LoggingMiddleware(logger))
+
+    handlers = [
+        TimedHandler(HandleLastVisitTime()),
+        TimedHandler(HandleMetrics(aggregate=options.aggregate_metrics)),
+        TimedHandler(
+            HandleAnalytics(
+                user_agent_cache_size=configuration.user_agent_cache_size,
+                geoip_cache_size=configuration.geoip_cache_size,
+            )
+        ),
+    ]
+    consumer.declare_handler(handlers[0], "URL.read")
+    consumer.declare_handler(handlers[1], ("URL.read", "URL.create"))
+    consumer.declare_handler(handlers[2], ("URL.read"))
+
+    if trace_allocations:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    try:
+        await consumer.run()
+    except StreamExhausted:
+        pass
+    finally:
+        elapsed = time.perf_counter() - start
+        if enrichment_executor is not None:
+            enrichment_executor.shutdown()
+
+    allocations = None
+    if trace_allocations:
+        statistics = tracemalloc.take_snapshot().compare_to(before, "filename")
+        allocations = {
+            "blocks_per_record": sum(stat.count_diff for stat in statistics)
+            / len(records),
+            "bytes_per_record": sum(stat.size_diff for stat in statistics)
+            / len(records),
+            "peak_bytes": tracemalloc.get_traced_memory()[1],
+        }
+        tracemalloc.stop()
+
+    return BenchmarkReport(
+        records=len(records),
+        elapsed=elapsed,
+        handlers={str(handler): dict(handler.timings) for handler in handlers},
+        analytics_rows=clickhouse_client.rows,
+        allocations=allocations,
+    )
+
+
+def parse_arguments(arguments: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmarks.consumer_throughput",
+        description=__doc__.split("\n")[0],
+    )
+    stream = parser.add_argument_group("stream")
+    stream.add_argument("--records", type=int, default=10_000)
+    stream.add_argument("--seed", type=int, default=0)
+    stream.add_argument("--hosts", type=int, default=200)
+    stream.add_argument("--links-per-host", type=int, default=20)
+    stream.add_argument("--networks", type=int, default=5_000)
+    stream.add_argument("--read-ratio", type=float, default=0.9)
+    stream.add_argument(
+        "--encoding",
+        choices=("json", "compact"),
+        default=configuration.kafka_message_encoding,
+    )
+    stream.add_argument("--partitions", type=int, default=3)
+    stream.add_argument("--save", type=Path, help="Store the generated stream.")
+    stream.add_argument("--replay", type=Path, help="Run a stored stream.")
+
+    consumer = parser.add_argument_group("consumer")
+    consumer.add_argument("--backend", choices=("mock", "local"), default="mock")
+    consumer.add_argument(
+        "--concurrency", type=int, default=configuration.consumer_concurrency
+    )
+    consumer.add_argument(
+        "--batch-size", type=int, default=configuration.consumer_batch_size
+    )
+    consumer.add_argument(
+        "--aggregate-metrics",
+        action=argparse.BooleanOptionalAction,
+        default=configuration.consumer_aggregate_metrics,
+    )
+    consumer.add_argument(
+        "--enrichment-processes",
+        type=int,
+        default=configuration.enrichment_processes,
+    )
+    consumer.add_argument("--geoip-database", default=configuration.geoip_database)
+
+    report = parser.add_argument_group("report")
+    report.add_argument(
+        "--allocations",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Measure allocations in a second run traced by tracemalloc.",
+    )
+    report.add_argument("--json", action="store_true", help="Print a JSON report.")
+    report.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(arguments)
+
+
+async def main(arguments: list[str] | None = None) -> BenchmarkReport:
+    options = parse_arguments(arguments)
+    logging.basicConfig(level=options.log_level)
+    logger = logging.getLogger("benchmark")
+
+    if options.replay is not None:
+        records = load_records(options.replay)
+    else:
+        records = await SyntheticStream(
+            records=options.records,
+            seed=options.seed,
+            hosts=options.hosts,
+            links_per_host=options.links_per_host,
+            networks=options.networks,
+            read_ratio=options.read_ratio,
+            encoding=options.encoding,
+            partitions=options.partitions,
+        ).generate()
+    if options.save is not None:
+        save_records(options.save, records)
+
+    report = await run_benchmark(records, options, logger)
+    if options.allocations:
+        traced = await run_benchmark(records, options, logger, trace_allocations=True)
+        report.allocations = traced.allocations
+
+    if options.json:
+        print(orjson.dumps(report.as_dict(), option=orjson.OPT_INDENT_2).decode())
+    else:
+        report.print()
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+import pytest
+from fastapi import status
+from fastapi.testclient import TestClient
+from httpx import AsyncClient
+
+from app import initialize_application
+from app.app import TypedApp
+from app.models import URL
+from app.schemas import CreateTinyURL
+from tests.fixtures.producer import MockKafkaProducer
+
+pytestmark = pytest.mark.benchmark
+
+BULK_SIZE = 100
+
+
+class Collections(dict):
+    """Collections of a database, each one created once.
+
+    mongomock_motor wraps inserts of a collection again whenever it's
+    looked up, so that the wrappers would nest with every request.
+    """
+
+    def __init__(self, database) -> None:
+        super().__init__()
+        self.database = database
+
+    def __missing__(self, name: str):
+        collection = self[name] = self.database[name]
+        return collection
+
+
+@pytest.fixture
+async def local_benchmark_client():
+    app = initialize_application()
+    app.producer = MockKafkaProducer()
+    with TestClient(app):
+        async with AsyncClient(app=app, base_url="http://test") as client:
+            yield client, app
+        app.producer.clean()
+
+
+@pytest.fixture
+def benchmark_client(request, benchmark):
+    """Client of the app with test doubles or with Redis and Mongo it's configured for."""
+    # Async fixtures are requested by name from a sync one, their event loop
+    # isn't running yet.
+    if request.config.getoption("--benchmark-backend") == "mock":
+        client, app = request.getfixturevalue("client"), request.getfixturevalue("app")
+        app.database = Collections(app.database)
+        return client, app
+    return request.getfixturevalue("local_benchmark_client")
+
+
+async def test_create(benchmark_client, benchmark, test_url: str):
+    client, _ = benchmark_client
+    payload = CreateTinyURL(url=test_url).dict()
+
+    async def create():
+        response = await client.post("/url/", json=payload)
+        assert response.status_code == status.HTTP_201_CREATED
+
+    await benchmark.measure("create", create)
+
+
+async def test_bulk_create(benchmark_client, benchmark, test_url: str):
+    client, _ = benchmark_client
+    payload = [CreateTinyURL(url=test_url).dict()] * BULK_SIZE
+
+    async def bulk_create():
+        response = await client.post("/url/bulk", json=payload)
+        assert response.status_code == status.HTTP_201_CREATED
+
+    await benchmark.measure(f"bulk_create[{BULK_SIZE}]", bulk_create)
+
+
+async def redirect(client: AsyncClient, url: URL, expected_status: int):
+    response = await client.get(f"/url/{url.tiny_url}", follow_redirects=False)
+    assert response.status_code == expected_status
+
+
+async def test_redirect_local_cache_hit(benchmark_client, benchmark, test_url: str):
+    client, app = benchmark_client
+    url = URL(url=test_url)
+    await app.database["tinyurl"].insert_one(url.dict())
+
+    await benchmark.measure(
+        "redirect_local_cache_hit",
+        lambda: redirect(client, url, status.HTTP_307_TEMPORARY_REDIRECT),
+    )
+    assert app.local_cache.hits >= benchmark.requests
+
+
+async def test_redirect_redis_hit(benchmark_client, benchmark, test_url: str):
+    client, app = benchmark_client
+    # Limited links are never kept in the local cache, every redirect goes
+    # through the Redis script.
+    url = URL(url=test_url, max_redirects=2**31)
+    await app.database["tinyurl"].insert_one(url.dict())
+
+    await benchmark.measure(
+        "redirect_redis_hit",
+        lambda: redirect(client, url, status.HTTP_307_TEMPORARY_REDIRECT),
+    )
+    assert url.tiny_url not in app.local_cache
+
+
+async def test_redirect_cache_miss(benchmark_client, benchmark, test_url: str):
+    client, app = benchmark_client
+    url = URL(url=test_url)
+    await app.database["tinyurl"].insert_one(url.dict())
+
+    async def evict():
+        app.local_cache.invalidate(url.tiny_url)
+        await app.redis.delete(url.tiny_url)
+
+    await benchmark.measure(
+        "redirect_cache_miss",
+        lambda: redirect(client, url, status.HTTP_307_TEMPORARY_REDIRECT),
+        setup=evict,
+    )
+
+
+async def test_redirect_expired(benchmark_client, benchmark, test_url: str):
+    client, app = benchmark_client
+    url = URL(url=test_url, time_to_live=0)
+    await app.database["tinyurl"].insert_one(url.dict())
+
+    await app.url_filter.add([url.tiny_url])
+
+    # Without it every request after the first would hit the cached entry of
+    # the missing link instead of finding the expired one.
+    async def evict():
+        await app.redis.delete(url.tiny_url)
+
+    await benchmark.measure(
+        "redirect_expired",
+        lambda: redirect(client, url, status.HTTP_404_NOT_FOUND),
+        setup=evict,
+    )
@@ -1,3 +1,4 @@
+from tests.fixtures.benchmark import *
 from tests.fixtures.clickhouse import *
 from tests.fixtures.common import *
 from tests.fixtures.producer import *
@@ -0,0 +1,36 @@
+import logging
+
+from tests.benchmarks.consumer_throughput import (
+    SyntheticStream,
+    load_records,
+    parse_arguments,
+    run_benchmark,
+    save_records,
+)
+
+
+async def test_synthetic_stream__is_replayable(tmp_path):
+    records = await SyntheticStream(records=50, seed=7).generate()
+    assert records == await SyntheticStream(records=50, seed=7).generate()
+
+    save_records(tmp_path / "stream.jsonl", records)
+    assert load_records(tmp_path / "stream.jsonl") == records
+
+
+async def test_run_benchmark__reports_every_handler():
+    records = await SyntheticStream(records=50, read_ratio=1.0).generate()
+    options = parse_arguments(["--batch-size", "10", "--geoip-database", "missing"])
+
+    report = await run_benchmark(
+        records, options, logging.getLogger(), trace_allocations=True
+    )
+
+    assert report.records == 50
+    assert report.analytics_rows == 50
+    assert set(report.handlers) == {
+        "HandleLastVisitTime",
+        "HandleMetrics",
+        "HandleAnalytics",
+    }
+    assert report.handlers["HandleMetrics"]["handle_batch"] > 0
+    assert report.allocations["peak_bytes"] > 0
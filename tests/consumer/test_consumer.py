@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import random
+
+from aiokafka import ConsumerRecord, TopicPartition
+
+from app.consumers import Consumer
+from app.consumers.handlers import BaseHandler
+from app.consumers.middleware import BaseMiddleware, Generator, RecordT
+from app.consumers.utils import OffsetTracker
+
+
+class PassMiddleware(BaseMiddleware):
+    async def __call__(self, record: RecordT, stack: Generator):
+        await next(stack)(record, stack)
+
+
+def make_record(offset: int, partition: int = 0, key: bytes | None = None):
+    return ConsumerRecord(
+        topic="URL.read",
+        partition=partition,
+        offset=offset,
+        timestamp=0,
+        timestamp_type=0,
+        key=key,
+        value=b"{}",
+        checksum=None,
+        serialized_key_size=0,
+        serialized_value_size=2,
+        headers=(),
+    )
+
+
+def test_offset_tracker__commits_only_contiguous_offsets():
+    partition = TopicPartition("URL.read", 0)
+    tracker = OffsetTracker()
+    for offset in range(3):
+        tracker.begin(partition, offset)
+
+    tracker.finish(partition, 2)
+    assert tracker.pop_committable() == {}
+
+    tracker.finish(partition, 0)
+    assert tracker.pop_committable() == {partition: 1}
+
+    tracker.finish(partition, 1)
+    assert tracker.pop_committable() == {partition: 3}
+
+
+async def test_concurrent_processing__keeps_per_key_order():
+    consumer = Consumer(
+        None, None, logger=logging.getLogger(), services={}, concurrency=8
+    )
+    consumer.declare_middleware(PassMiddleware())
+    processed: dict[bytes, list[int]] = {}
+    running, max_running = 0, 0
+
+    async def handler(record):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(random.random() / 100)
+        processed.setdefault(record.key, []).append(record.offset)
+        running -= 1
+
+    consumer.declare_handler(handler, "URL.read")
+    records = [
+        make_record(offset, key=str(offset % 4).encode()) for offset in range(40)
+    ]
+    for record in records:
+        await consumer._slots.acquire()
+        consumer.schedule(record)
+    await consumer.drain()
+
+    assert max_running > 1
+    assert all(offsets == sorted(offsets) for offsets in processed.values())
+    assert sum(len(offsets) for offsets in processed.values()) == 40
+
+
+async def test_concurrent_processing__commits_after_earlier_records_finished():
+    consumer = Consumer(
+        None, None, logger=logging.getLogger(), services={}, concurrency=2
+    )
+    consumer.declare_middleware(PassMiddleware())
+    release_first = asyncio.Event()
+
+    async def handler(record):
+        if record.offset == 0:
+            await release_first.wait()
+
+    consumer.declare_handler(handler, "URL.read")
+    for offset, key in enumerate((b"a", b"b")):
+        await consumer._slots.acquire()
+        consumer.schedule(make_record(offset, key=key))
+    await asyncio.sleep(0.01)
+
+    assert consumer.offsets.pop_committable() == {}
+    release_first.set()
+    await asyncio.gather(*consumer._tails.values())
+    await asyncio.sleep(0)
+    assert consumer.offsets.pop_committable() == {TopicPartition("URL.read", 0): 2}
+
+
+async def test_batch_processing__hands_records_to_handlers_at_once():
+    consumer = Consumer(None, None, logger=logging.getLogger(), services={})
+    consumer.declare_middleware(PassMiddleware())
+    batches = []
+
+    class BatchHandler(BaseHandler):
+        async def __call__(self, record):
+            raise AssertionError("Records should be handled in a batch.")
+
+        async def handle_batch(self, records):
+            batches.append([record.offset for record in records])
+
+    consumer.declare_handler(BatchHandler(), "URL.read")
+    await consumer.process_batch([make_record(offset) for offset in range(5)])
+
+    assert batches == [[0, 1, 2, 3, 4]]
+    assert consumer.offsets.pop_committable() == {TopicPartition("URL.read", 0): 5}
+
+
+async def test_record_processing__commits_without_new_records():
+    consumer = Consumer(
+        None, None, logger=logging.getLogger(), services={}, commit_interval=0.05
+    )
+    consumer.declare_middleware(PassMiddleware())
+    flushed = []
+
+    class BufferingHandler(BaseHandler):
+        async def __call__(self, record):
+            pass
+
+        async def flush(self, committed=None):
+            flushed.append(committed)
+
+    class QuietKafkaConsumer:
+        def __init__(self) -> None:
+            self.records = [make_record(0)]
+
+        async def getone(self):
+            if self.records:
+                return self.records.pop()
+            await asyncio.Event().wait()
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            return await self.getone()
+
+    consumer.declare_handler(BufferingHandler(), "URL.read")
+    consumer.consumer = QuietKafkaConsumer()
+    task = asyncio.create_task(consumer._consume_records())
+    await asyncio.sleep(0.2)
+    task.cancel()
+
+    assert flushed == [{TopicPartition("URL.read", 0): 1}]
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_network
+from unittest.mock import MagicMock
+
+import pytest
+from geoip2.errors import AddressNotFoundError
+
+from app.consumers import enrichment
+from app.consumers.enrichment import (
+    UNKNOWN_LOCATION,
+    Enricher,
+    GeoIPResolver,
+    UserAgentParser,
+)
+
+
+@pytest.fixture
+def reader():
+    reader = MagicMock()
+    reader.country.return_value.country.iso_code = "CA"
+    reader.country.return_value.traits.network = ip_network("207.23.0.0/16")
+    return reader
+
+
+@pytest.mark.parametrize(
+    "ip_address",
+    (
+        pytest.param(None, id="No IP address."),
+        pytest.param("not an address", id="Invalid IP address."),
+        pytest.param("192.168.1.15", id="A private IP address."),
+        pytest.param("127.0.0.1", id="A loopback IP address."),
+        pytest.param("fe80::1", id="A link-local IPv6 address."),
+    ),
+)
+def test_geoip_resolver__skips_non_global_addresses(reader, ip_address):
+    assert GeoIPResolver(reader)(ip_address) == UNKNOWN_LOCATION
+    reader.country.assert_not_called()
+
+
+def test_geoip_resolver__caches_whole_network(reader):
+    resolver = GeoIPResolver(reader)
+
+    assert resolver("207.23.240.87") == resolver("207.23.240.1") == "CA"
+    reader.country.assert_called_once_with("207.23.240.87")
+
+
+def test_geoip_resolver__caches_single_address_of_small_network(reader):
+    reader.country.side_effect = AddressNotFoundError("Not found.")
+    resolver = GeoIPResolver(reader)
+
+    assert resolver("207.23.240.87") == resolver("207.23.240.87") == UNKNOWN_LOCATION
+    assert resolver("207.23.240.1") == UNKNOWN_LOCATION
+    assert reader.country.call_count == 2
+
+
+def test_geoip_resolver__counts_each_address_once(reader):
+    reader.country.side_effect = AddressNotFoundError("Not found.")
+    resolver = GeoIPResolver(reader)
+
+    resolver("207.23.240.87")
+    resolver("207.23.240.87")
+
+    assert resolver.cache.info()["misses"] == 1
+    assert resolver.cache.info()["hits"] == 1
+
+
+async def test_enricher__looks_up_misses_in_executor(reader, monkeypatch):
+    monkeypatch.setattr(enrichment, "_worker_geoip", GeoIPResolver(reader))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        enrich = Enricher(GeoIPResolver(reader), UserAgentParser(), executor)
+        for _ in range(2):
+            location, user_agent = await enrich("207.23.240.87", "curl/7.64.1")
+
+    assert location == "CA"
+    assert user_agent == UserAgentParser.parse("curl/7.64.1")
+    reader.country.assert_called_once_with("207.23.240.87")
+    assert enrich.user_agents.cache.hits == 1
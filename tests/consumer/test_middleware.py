@@ -1,7 +1,19 @@
 import logging
 
+import pytest
+from aiokafka import ConsumerRecord
+
 from app.consumers import Consumer
-from app.consumers.middleware import BaseMiddleware, Generator, ParsedRecord, RecordT
+from app.consumers.middleware import (
+    BaseMiddleware,
+    Generator,
+    OrJSONMiddleware,
+    ParsedRecord,
+    RecordT,
+)
+from app.messaging import send_message
+from app.models import URL
+from tests.fixtures.producer import MockKafkaProducer
 
 
 class CountingMiddleware(BaseMiddleware):
@@ -29,3 +41,42 @@ async def test_middleware_stack():
     await consumer.middleware[0](record, consumer.stack())
     assert CountingMiddleware.class_counter == 10
     assert all(middleware.counter == 1 for middleware in consumer.middleware)
+
+
+@pytest.mark.parametrize("encoding", ("json", "compact"))
+async def test_orjson_middleware__reads_both_encodings(
+    encoding: str, test_url_model: URL
+):
+    producer = MockKafkaProducer()
+    await send_message(
+        producer,
+        "read",
+        test_url_model,
+        additional_data={"ip_address": "207.23.240.87", "user_agent": None},
+        encoding=encoding,
+    )
+    topic, value = producer.queue[0]
+    record = ConsumerRecord(
+        topic=topic,
+        partition=0,
+        offset=0,
+        timestamp=0,
+        timestamp_type=0,
+        key=producer.keys[0],
+        value=value,
+        checksum=None,
+        serialized_key_size=0,
+        serialized_value_size=len(value),
+        headers=producer.headers[0],
+    )
+    decoded = []
+
+    async def collect(record, stack):
+        decoded.append(record.value)
+
+    await OrJSONMiddleware()(record, iter([collect]))
+
+    assert decoded[0]["tiny_url"] == test_url_model.tiny_url
+    assert decoded[0]["url"] == test_url_model.url
+    assert decoded[0]["ip_address"] == "207.23.240.87"
+    assert decoded[0]["user_agent"] is None
@@ -0,0 +1,231 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import pytest
+from clickhouse_connect import get_client
+from clickhouse_connect.driver.exceptions import OperationalError
+
+from app.config import configuration
+from app.consumers.handlers import ANALYTICS_COLUMNS
+from app.consumers.schema import (
+    MIGRATIONS,
+    MIGRATIONS_TABLE,
+    create_legacy_tables,
+    create_tables,
+    create_tables_exclusively,
+)
+from tests.fixtures.redis import AioRedisMock
+
+
+def make_client(
+    applied: int = 0,
+    tables: set[str] = frozenset(),
+    ip_address_type: str = "String",
+    create_table_query: str = "CREATE TABLE default.analytics (...)",
+):
+    def command(command: str):
+        if command.startswith("SELECT max(version)"):
+            return applied
+        if command.startswith("EXISTS TABLE"):
+            return int(command.split()[-1] in tables)
+        if command.startswith("SELECT type"):
+            return ip_address_type
+        if command.startswith("SELECT create_table_query"):
+            return create_table_query
+        return None
+
+    client = MagicMock()
+    client.command.side_effect = command
+    return client
+
+
+def executed(client: MagicMock) -> list[str]:
+    return [call.args[0].strip() for call in client.command.call_args_list]
+
+
+def test_create_tables__creates_latest_schema_on_a_new_database():
+    client = make_client()
+
+    create_tables(client)
+
+    commands = executed(client)
+    assert any(command.startswith("CREATE TABLE analytics (") for command in commands)
+    assert not any(command.startswith("EXCHANGE") for command in commands)
+    assert (
+        f"INSERT INTO schema_migrations (version) VALUES ({MIGRATIONS[-1][0]})"
+        in commands
+    )
+
+
+def test_create_tables__migrates_legacy_table():
+    client = make_client(tables={"analytics", "analytics_daily", "analytics_migration"})
+
+    create_tables(client)
+
+    commands = executed(client)
+    assert "EXCHANGE TABLES analytics_migration AND analytics" in commands
+    assert "RENAME TABLE analytics_migration TO analytics_legacy" in commands
+    assert any(
+        command.startswith("INSERT INTO analytics_daily") for command in commands
+    )
+    assert [
+        command
+        for command in commands
+        if command.startswith("INSERT INTO schema_migrations")
+    ] == [
+        f"INSERT INTO schema_migrations (version) VALUES ({version})"
+        for version, _ in MIGRATIONS
+    ]
+
+
+def test_create_tables__aggregates_late_rows_into_rollup():
+    client = make_client()
+
+    create_tables(client)
+
+    commands = executed(client)
+    (view,) = [command for command in commands if "MATERIALIZED VIEW" in command]
+    # Rows waiting in Kafka during the migration are older than it.
+    assert "timestamp >=" not in view
+    assert "WHERE" not in view
+
+
+def test_create_tables__skips_applied_migrations():
+    client = make_client(applied=MIGRATIONS[-1][0], tables={"analytics"})
+
+    create_tables(client)
+
+    assert not any(command.startswith("INSERT") for command in executed(client))
+
+
+@pytest.mark.parametrize(
+    ("create_table_query", "ttl_days", "expected"),
+    (
+        pytest.param(
+            "CREATE TABLE default.analytics (...) ORDER BY x",
+            30,
+            "ALTER TABLE analytics MODIFY TTL timestamp + INTERVAL 30 DAY",
+            id="TTL is added.",
+        ),
+        pytest.param(
+            "CREATE TABLE default.analytics (...) TTL timestamp + toIntervalDay(30)",
+            30,
+            None,
+            id="TTL is up to date.",
+        ),
+        pytest.param(
+            "CREATE TABLE default.analytics (...) TTL timestamp + toIntervalDay(30)",
+            None,
+            "ALTER TABLE analytics REMOVE TTL",
+            id="TTL is removed.",
+        ),
+    ),
+)
+def test_create_tables__sets_ttl(
+    create_table_query: str, ttl_days: int | None, expected: str | None
+):
+    client = make_client(
+        applied=MIGRATIONS[-1][0],
+        tables={"analytics"},
+        create_table_query=create_table_query,
+    )
+
+    create_tables(client, ttl_days)
+
+    alters = [command for command in executed(client) if command.startswith("ALTER")]
+    assert alters == ([expected] if expected else [])
+
+
+async def test_create_tables_exclusively__releases_lock():
+    redis = AioRedisMock()
+    client = make_client()
+
+    await create_tables_exclusively(redis, client, lock_timeout=60)
+
+    assert any(command.startswith("CREATE TABLE") for command in executed(client))
+    assert not await redis.lock("analytics:schema").locked()
+
+
+@pytest.fixture
+def clickhouse():
+    """Client of a new database on the configured server, skipped without one."""
+    try:
+        server = get_client(dsn=configuration.clickhouse_dsn, connect_timeout=2)
+    except OperationalError as exc:
+        pytest.skip(f"ClickHouse isn't available: {exc}")
+    database = f"test_schema_{uuid4().hex}"
+    server.command(f"CREATE DATABASE {database}")
+    try:
+        yield get_client(dsn=configuration.clickhouse_dsn, database=database)
+    finally:
+        server.command(f"DROP DATABASE {database}")
+        server.close()
+
+
+def legacy_row(ip_address: str, timestamp: datetime) -> tuple:
+    return (
+        "example.com",
+        "https://example.com/",
+        "abc",
+        timestamp,
+        ip_address,
+        "CA",
+        "Other",
+        "Other",
+        "Other",
+        False,
+        False,
+    )
+
+
+def test_create_tables__migrates_legacy_rows(clickhouse):
+    clickhouse.command(MIGRATIONS_TABLE)
+    create_legacy_tables(clickhouse)
+    clickhouse.command("INSERT INTO schema_migrations (version) VALUES (1)")
+    addresses = ["207.23.240.87", "2001:db8::1", "", "invalid"]
+    clickhouse.insert(
+        "analytics",
+        [
+            legacy_row(address, datetime(2023, 1, 1, 12, i))
+            for i, address in enumerate(addresses)
+        ],
+        ANALYTICS_COLUMNS,
+    )
+
+    create_tables(clickhouse)
+    create_tables(clickhouse)
+
+    assert (
+        clickhouse.command(
+            "SELECT type FROM system.columns WHERE database = currentDatabase()"
+            " AND table = 'analytics' AND name = 'ip_address'"
+        )
+        == "IPv6"
+    )
+    migrated = clickhouse.query(
+        "SELECT toString(ip_address) FROM analytics ORDER BY timestamp"
+    ).result_rows
+    assert [address for address, in migrated] == [
+        "::ffff:207.23.240.87",
+        "2001:db8::1",
+        "::",
+        "::",
+    ]
+    # Rows inserted after the migration are aggregated by the view.
+    clickhouse.insert(
+        "analytics",
+        [legacy_row("::", datetime.now() + timedelta(days=1))],
+        ANALYTICS_COLUMNS,
+    )
+    assert clickhouse.command("SELECT sum(visits) FROM analytics_daily") == 5
+
+
+def test_create_tables__creates_latest_schema_once(clickhouse):
+    create_tables(clickhouse)
+    create_tables(clickhouse)
+
+    assert clickhouse.command("SELECT max(version) FROM schema_migrations") == (
+        MIGRATIONS[-1][0]
+    )
+    assert clickhouse.command("EXISTS TABLE analytics_daily")
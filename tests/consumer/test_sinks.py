@@ -0,0 +1,72 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from clickhouse_connect.datatypes.registry import get_from_name
+from clickhouse_connect.driver.insert import InsertContext
+
+from app.consumers.handlers import HandleAnalytics
+from app.consumers.sinks import ClickHouseSink
+
+COLUMNS = ("tiny_url", "visits")
+
+
+async def test_sink_inserts_full_batches():
+    client = MagicMock()
+    sink = ClickHouseSink(client, "analytics", COLUMNS, max_batch_size=10)
+    for i in range(25):
+        await sink.put((str(i), i))
+    await sink.flush()
+
+    assert client.insert.call_count == 3
+    inserted = [row for call in client.insert.call_args_list for row in call.args[1]]
+    assert inserted == [(str(i), i) for i in range(25)]
+    assert all(call.args[2] == COLUMNS for call in client.insert.call_args_list)
+
+
+async def test_sink_flushes_after_interval():
+    client = MagicMock()
+    sink = ClickHouseSink(client, "analytics", COLUMNS, flush_interval=0.01)
+    await sink.start()
+    await sink.put(("a", 1))
+    await asyncio.sleep(0.1)
+
+    client.insert.assert_called_once_with("analytics", [("a", 1)], COLUMNS)
+    await sink.close()
+
+
+async def test_sink_requeues_rows_of_failed_insert():
+    client = MagicMock()
+    client.insert.side_effect = [ConnectionError(), None]
+    sink = ClickHouseSink(client, "analytics", COLUMNS)
+    await sink.put(("a", 1))
+
+    with pytest.raises(ConnectionError):
+        await sink.flush()
+    await sink.flush()
+
+    assert client.insert.call_count == 2
+    assert client.insert.call_args.args[1] == [("a", 1)]
+
+
+async def test_sink_writes_batch_starting_without_address():
+    ipv6 = get_from_name("IPv6")
+
+    def insert(table, rows, column_names):
+        column = [row[0] for row in rows]
+        context = InsertContext(table, column_names, [ipv6], data=rows)
+        ipv6.write_column(column, bytearray(), context)
+
+    client = MagicMock()
+    client.insert.side_effect = insert
+    sink = ClickHouseSink(client, "analytics", ("ip_address",))
+    for address in (None, "207.23.240.87", "invalid", "::1"):
+        await sink.put((HandleAnalytics.ip_column(address),))
+    await sink.flush()
+
+    assert client.insert.call_args.args[1] == [
+        ("::",),
+        ("207.23.240.87",),
+        ("::",),
+        ("::1",),
+    ]
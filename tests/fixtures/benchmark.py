@@ -0,0 +1,166 @@
+import json
+import statistics
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+BASELINE_PATH = Path(__file__).parent.parent / "benchmarks" / "baseline.json"
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Run benchmarks, they are skipped otherwise.",
+    )
+    group.addoption(
+        "--benchmark-backend",
+        choices=("mock", "local"),
+        default="mock",
+        help="Run against test doubles or Redis and Mongo from the configuration.",
+    )
+    group.addoption("--benchmark-requests", type=int, default=1000)
+    group.addoption("--benchmark-baseline", type=Path, default=BASELINE_PATH)
+    group.addoption(
+        "--benchmark-save",
+        action="store_true",
+        default=False,
+        help="Store results as the new baseline.",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown relative to the baseline, 0.25 stands for 25%%.",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="Benchmarks run only with --benchmark.")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    latencies: list[float]
+    elapsed: float
+
+    def percentile(self, percentile: int) -> float:
+        return statistics.quantiles(self.latencies, n=100)[percentile - 1]
+
+    @property
+    def p50(self) -> float:
+        return statistics.median(self.latencies)
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(99)
+
+    @property
+    def requests_per_second(self) -> float:
+        return len(self.latencies) / self.elapsed
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "p50_ms": self.p50 * 1000,
+            "p99_ms": self.p99 * 1000,
+            "requests_per_second": self.requests_per_second,
+        }
+
+
+@dataclass
+class Benchmark:
+    requests: int
+    tolerance: float
+    baseline: dict[str, dict[str, float]]
+    results: dict[str, BenchmarkResult] = field(default_factory=dict)
+
+    async def measure(
+        self,
+        name: str,
+        request: Callable[[], Awaitable[Any]],
+        *,
+        setup: Callable[[], Awaitable[Any]] | None = None,
+        warmup: int = 10,
+    ) -> BenchmarkResult:
+        """Time sequential requests, ``setup`` runs before each and isn't timed."""
+        latencies = []
+        for iteration in range(warmup + self.requests):
+            if setup is not None:
+                await setup()
+            start = time.perf_counter()
+            await request()
+            latency = time.perf_counter() - start
+            if iteration >= warmup:
+                latencies.append(latency)
+        result = BenchmarkResult(name, latencies, sum(latencies))
+        self.results[name] = result
+        regressions = self.regressions(result)
+        assert not regressions, f"{name} regressed: {', '.join(regressions)}"
+        return result
+
+    def regressions(self, result: BenchmarkResult) -> list[str]:
+        baseline = self.baseline.get(result.name)
+        if baseline is None:
+            return []
+        current = result.summary()
+        regressions = [
+            f"{metric}: {current[metric]:.3f} > {baseline[metric]:.3f}"
+            for metric in ("p50_ms", "p99_ms")
+            if current[metric] > baseline[metric] * (1 + self.tolerance)
+        ]
+        if current["requests_per_second"] < baseline["requests_per_second"] * (
+            1 - self.tolerance
+        ):
+            regressions.append(
+                f"requests_per_second: {current['requests_per_second']:.1f}"
+                f" < {baseline['requests_per_second']:.1f}"
+            )
+        return regressions
+
+
+benchmark_key = pytest.StashKey["Benchmark"]()
+
+
+@pytest.fixture(scope="session")
+def benchmark(pytestconfig):
+    baseline_path: Path = pytestconfig.getoption("--benchmark-baseline")
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    benchmark = Benchmark(
+        requests=pytestconfig.getoption("--benchmark-requests"),
+        tolerance=pytestconfig.getoption("--benchmark-tolerance"),
+        baseline=baseline,
+    )
+    pytestconfig.stash[benchmark_key] = benchmark
+    yield benchmark
+    if pytestconfig.getoption("--benchmark-save") and benchmark.results:
+        baseline.update(
+            {name: result.summary() for name, result in benchmark.results.items()}
+        )
+        baseline_path.write_text(json.dumps(baseline, indent=4, sort_keys=True))
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    benchmark = config.stash.get(benchmark_key, None)
+    if benchmark is None or not benchmark.results:
+        return
+    terminalreporter.section("benchmark")
+    terminalreporter.write_line(
+        f"{'name':<40}{'p50 [ms]':>12}{'p99 [ms]':>12}{'req/s':>12}"
+    )
+    for name, result in benchmark.results.items():
+        summary = result.summary()
+        terminalreporter.write_line(
+            f"{name:<40}{summary['p50_ms']:>12.3f}{summary['p99_ms']:>12.3f}"
+            f"{summary['requests_per_second']:>12.1f}"
+        )
@@ -37,6 +37,7 @@ async def client(app: TypedApp):
         yield client
     app.redis.clean()
     app.producer.clean()
+    app.local_cache.clear()
 
 
 @pytest.fixture
@@ -1,3 +1,4 @@
+import asyncio
 from collections import deque
 from typing import Any
 from unittest.mock import patch
@@ -9,12 +10,21 @@ import pytest
 class MockKafkaProducer:
     def __init__(self) -> None:
         self.queue: deque[tuple[Any, Any]] = deque()
+        self.keys: deque[bytes | None] = deque()
+        self.headers: deque[list[tuple[str, bytes]]] = deque()
 
-    async def send(self, topic, value):
+    async def send(self, topic, value, key=None, headers=None):
         self.queue.append((topic, value))
+        self.keys.append(key)
+        self.headers.append(headers or [])
+        delivery = asyncio.get_running_loop().create_future()
+        delivery.set_result(None)
+        return delivery
 
     def get(self, *, decode_value: bool = False):
         topic, value = self.queue.popleft()
+        self.keys.popleft()
+        self.headers.popleft()
         if decode_value:
             value = orjson.loads(value)
         return topic, value
@@ -25,8 +35,13 @@ class MockKafkaProducer:
     async def start(self):
         pass
 
+    async def stop(self):
+        pass
+
     def clean(self):
         self.queue.clear()
+        self.keys.clear()
+        self.headers.clear()
 
 
 @pytest.fixture(scope="session")
@@ -1,10 +1,14 @@
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from typing import Any, Generic, TypeVar
 from unittest.mock import patch
 
+import orjson
 import pytest
 
+from app.cache import MISSING, READ_AND_DECREMENT
+
 T = TypeVar("T")
 
 
@@ -12,7 +16,7 @@ T = TypeVar("T")
 class Expirable(Generic[T]):
     data: T
     ttl: int | None
-    created_at: datetime = datetime.now()
+    created_at: datetime = field(default_factory=datetime.now)
     fetch_times: int = 0
 
     @property
@@ -25,15 +29,37 @@ class Expirable(Generic[T]):
 class AioRedisMock:
     def __init__(self, *args, **kwargs) -> None:
         self.store: dict[Any, Expirable] = {}
+        self.executed_pipelines = 0
 
     async def set(
         self,
         key: Any,
         value: Any,
-        ex: timedelta | None = None,
-        __created_at: datetime | None = None,
+        ex: timedelta | int | None = None,
+        px: timedelta | int | None = None,
     ):
-        self.store[key] = Expirable(data=value, ttl=ex.seconds if ex else ex)
+        if isinstance(ex, int):
+            ex = timedelta(seconds=ex)
+        if isinstance(px, int):
+            px = timedelta(milliseconds=px)
+        ttl = ex or px
+        self.store[key] = Expirable(
+            data=value, ttl=ttl.total_seconds() if ttl else None
+        )
+
+    def pttl(self, key) -> int:
+        entry = self.store.get(key)
+        if entry is None:
+            return -2
+        if entry.ttl is None:
+            return -1
+        elapsed = datetime.now() - entry.created_at
+        return int((timedelta(seconds=entry.ttl) - elapsed).total_seconds() * 1000)
+
+    def pexpire(self, key, milliseconds: int):
+        entry = self.store[key]
+        entry.created_at = datetime.now()
+        entry.ttl = milliseconds / 1000
 
     async def get(self, key):
         res = self.store.get(key)
@@ -44,8 +70,142 @@ class AioRedisMock:
             res.fetch_times += 1
         return res.data if res else None
 
+    async def exists(self, *keys):
+        return sum([await self.get(key) is not None for key in keys])
+
+    async def setbit(self, key, offset: int, value: int):
+        bits = self.store.setdefault(key, Expirable(data=set(), ttl=None)).data
+        previous = int(offset in bits)
+        if value:
+            bits.add(offset)
+        else:
+            bits.discard(offset)
+        return previous
+
+    async def getbit(self, key, offset: int):
+        return int(offset in (await self.get(key) or ()))
+
+    def lock(self, name, timeout: float | None = None, **kwargs):
+        return MockLock(self, name, timeout)
+
+    async def delete(self, *keys):
+        return sum(self.store.pop(key, None) is not None for key in keys)
+
+    async def close(self):
+        pass
+
+    @property
+    def connection_pool(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    def pipeline(self, transaction: bool = True):
+        return MockPipeline(self)
+
+    def register_script(self, script: str):
+        return MockScript(self, SCRIPTS[script])
+
     def clean(self):
         self.store = {}
+        self.executed_pipelines = 0
+
+
+class MockPipeline:
+    def __init__(self, redis: AioRedisMock) -> None:
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        def buffer(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return buffer
+
+    async def execute(self):
+        self.redis.executed_pipelines += 1
+        commands, self.commands = self.commands, []
+        return [
+            await getattr(self.redis, name)(*args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+class MockLock:
+    def __init__(self, redis: AioRedisMock, name, timeout: float | None) -> None:
+        self.redis = redis
+        self.name = name
+        self.timeout = timeout
+
+    async def acquire(self, blocking: bool | None = None, **kwargs):
+        if await self.redis.get(self.name) is not None:
+            return False
+        await self.redis.set(self.name, b"locked")
+        return True
+
+    async def release(self):
+        await self.redis.delete(self.name)
+
+    async def __aenter__(self):
+        if not await self.acquire():
+            raise RuntimeError(f"{self.name} is locked.")
+        return self
+
+    async def __aexit__(self, *args):
+        await self.release()
+
+    async def locked(self):
+        return await self.redis.get(self.name) is not None
+
+
+class MockScript:
+    def __init__(self, redis: AioRedisMock, implementation) -> None:
+        self.redis = redis
+        self.implementation = implementation
+
+    async def __call__(self, keys=(), args=(), client=None):
+        return await self.implementation(self.redis, list(keys), list(args))
+
+
+async def _read_and_decrement(redis: AioRedisMock, keys: list, args: list):
+    cached = await redis.get(keys[0])
+    if cached is None:
+        return None
+    entry = orjson.loads(cached)
+    if not isinstance(entry, list):
+        return cached
+    ttl = min(max(redis.pttl(keys[0]), 0) + args[0], args[1])
+    if len(entry) > 2 and entry[2] is not None:
+        left = (entry[2] - time.time()) * 1000
+        if left <= 0:
+            await redis.delete(keys[0])
+            return None
+        ttl = min(ttl, left)
+    remaining = entry[1]
+    if remaining is None:
+        redis.pexpire(keys[0], ttl)
+        return cached
+    if remaining < 1:
+        await redis.set(keys[0], MISSING, px=int(ttl))
+        return MISSING
+    if remaining == 1:
+        await redis.set(keys[0], MISSING, px=int(ttl))
+    else:
+        entry[1] = remaining - 1
+        redis.store[keys[0]].data = orjson.dumps(entry)
+        redis.pexpire(keys[0], ttl)
+    return cached
+
+
+SCRIPTS = {READ_AND_DECREMENT: _read_and_decrement}
 
 
 @pytest.fixture(scope="session")
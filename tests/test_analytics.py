@@ -0,0 +1,57 @@
+from datetime import date, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import status
+from httpx import AsyncClient
+
+from app.app import TypedApp
+
+
+@pytest.fixture
+def clickhouse_client(app: TypedApp, monkeypatch):
+    client = MagicMock()
+    client.query.return_value.named_results.side_effect = lambda: [
+        {"visits": 3, "day": date(2023, 1, 1), "unique_visits": 2}
+    ]
+    # Replaces the cached property without connecting to ClickHouse.
+    monkeypatch.setitem(vars(app), "clickhouse_client", client)
+    return client
+
+
+async def test_stats_of_past_days_are_cached_for_a_long_time(
+    client: AsyncClient, app: TypedApp, clickhouse_client: MagicMock
+):
+    params = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+    for _ in range(2):
+        response = await client.get("/analytics/tiny_url/abc/stats", params=params)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == [
+            {"visits": 3, "day": "2023-01-01", "unique_visits": 2}
+        ]
+
+    clickhouse_client.query.assert_called_once()
+    cached = app.redis.store["analytics:abc:2023-01-01:2023-01-31"]
+    assert cached.ttl == app.config.analytics_cache_ttl_seconds
+
+
+async def test_stats_of_recent_days_are_cached_separately(
+    client: AsyncClient, app: TypedApp, clickhouse_client: MagicMock
+):
+    today = date.today()
+    start_date = today - timedelta(days=7)
+    response = await client.get(
+        "/analytics/tiny_url/abc/stats",
+        params={"start_date": start_date.isoformat(), "end_date": today.isoformat()},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()) == 2
+    assert clickhouse_client.query.call_count == 2
+    # Yesterday may still receive late events, so it's cached with today.
+    recent_start = today - timedelta(days=1)
+    settled_end = today - timedelta(days=2)
+    past = app.redis.store[f"analytics:abc:{start_date}:{settled_end}"]
+    assert past.ttl == app.config.analytics_cache_ttl_seconds
+    recent = app.redis.store[f"analytics:abc:{recent_start}:{today}"]
+    assert recent.ttl == app.config.analytics_recent_cache_ttl_seconds
@@ -1,10 +1,18 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
 import orjson
 from fastapi import status
 from httpx import AsyncClient
+from mongomock_motor import AsyncMongoMockClient
 
 from app.app import TypedApp
+from app.cache import MISSING, BloomFilter, SingleFlight
 from app.models import URL
+from app.routes import url as url_routes
 from app.schemas import CreateTinyURL
+from tests.fixtures.redis import AioRedisMock
 
 
 async def test_cache_is_refreshed_after_insert(
@@ -53,3 +61,316 @@ async def test_cache_is_refreshed_after_details(
     assert response.status_code == status.HTTP_200_OK
     data = orjson.loads((await app.redis.get(url.tiny_url)))
     assert data[0] == url.url
+
+
+async def test_unlimited_url_is_served_from_local_cache(
+    client: AsyncClient, app: TypedApp, test_url: str, faker
+):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.set(tiny_url, orjson.dumps((test_url, None)))
+    for _ in range(3):
+        response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+        assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+
+    assert app.redis.store[tiny_url].fetch_times == 1
+    assert app.local_cache.hits == 2
+    assert len(app.producer.queue) == 3
+
+
+async def test_limited_url_bypasses_local_cache(
+    client: AsyncClient, app: TypedApp, test_url: str, faker
+):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.set(tiny_url, orjson.dumps((test_url, 5)))
+    for _ in range(2):
+        response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+        assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+
+    assert tiny_url not in app.local_cache
+    assert app.local_cache.hits == 0
+    assert orjson.loads(await app.redis.get(tiny_url))[1] == 3
+
+
+async def test_local_cache_is_filled_by_redirects_only(
+    client: AsyncClient, app: TypedApp, test_url: str
+):
+    response = await client.post(
+        "/url/bulk", json=[CreateTinyURL(url=test_url).dict()] * 3
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    tiny_urls = [url["tiny_url"] for url in response.json()]
+    assert not any(tiny_url in app.local_cache for tiny_url in tiny_urls)
+
+    await app.redis.delete(tiny_urls[0])
+    response = await client.get(f"/url/{tiny_urls[0]}", follow_redirects=False)
+
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+    assert tiny_urls[0] in app.local_cache
+    assert len(app.local_cache) == 1
+
+
+async def test_cached_redirects_of_limited_url_are_consumed(
+    client: AsyncClient, app: TypedApp, test_url: str, faker
+):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.set(tiny_url, orjson.dumps((test_url, 2)))
+    for _ in range(2):
+        response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+        assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+
+    assert app.redis.store[tiny_url].data == MISSING
+    response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_loaded_limited_url_redirects_exactly_max_redirects_times(
+    client: AsyncClient, app: TypedApp, test_url: str
+):
+    # Consumers haven't decremented the stored count yet.
+    url = URL(url=test_url, max_redirects=2)
+    await app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+
+    statuses = [
+        (await client.get(f"/url/{url.tiny_url}", follow_redirects=False)).status_code
+        for _ in range(5)
+    ]
+
+    assert (
+        statuses
+        == [status.HTTP_307_TEMPORARY_REDIRECT] * 2 + [status.HTTP_404_NOT_FOUND] * 3
+    )
+
+
+async def test_details_keep_cached_count_of_limited_url(
+    client: AsyncClient, app: TypedApp, test_url: str
+):
+    url = URL(url=test_url, max_redirects=5)
+    await app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+    await app.redis.set(url.tiny_url, orjson.dumps([url.url, 1, None]))
+
+    response = await client.get(f"/url/{url.tiny_url}/details")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert orjson.loads(await app.redis.get(url.tiny_url))[1] == 1
+
+
+async def test_missing_url_is_cached(client: AsyncClient, app: TypedApp, faker):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    for _ in range(2):
+        response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    assert app.redis.store[tiny_url].data == MISSING
+    assert app.redis.store[tiny_url].fetch_times == 1
+
+
+async def test_missing_url_entry_is_replaced_on_creation(
+    client: AsyncClient, app: TypedApp, test_url: str
+):
+    url = URL(url=test_url)
+    await app.redis.set(url.tiny_url, MISSING)
+    await app.database["tinyurl"].insert_one(url.dict())
+    response = await client.get(f"/url/{url.tiny_url}/details")
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.get(f"/url/{url.tiny_url}", follow_redirects=False)
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+
+
+async def test_cache_entry_does_not_outlive_link(
+    client: AsyncClient, app: TypedApp, test_url: str
+):
+    url = URL(
+        url=test_url,
+        time_to_live=1,
+        creation_time=datetime.now() - timedelta(minutes=59, seconds=30),
+    )
+    await app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+    response = await client.get(f"/url/{url.tiny_url}", follow_redirects=False)
+
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+    cached = app.redis.store[url.tiny_url]
+    assert 0 < cached.ttl <= 30
+    assert orjson.loads(cached.data)[2] == int(url.expires_at.timestamp())
+
+
+async def test_expired_cache_entry_is_not_served(
+    client: AsyncClient, app: TypedApp, test_url: str, faker
+):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.set(tiny_url, orjson.dumps((test_url, None, time.time() - 1)))
+    response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_hit_extends_cached_link(
+    client: AsyncClient, app: TypedApp, test_url: str, faker
+):
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.set(
+        tiny_url, orjson.dumps((test_url, 5, None)), ex=timedelta(minutes=1)
+    )
+    response = await client.get(f"/url/{tiny_url}", follow_redirects=False)
+
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+    assert app.redis.store[tiny_url].ttl > 60
+    assert app.redis.store[tiny_url].ttl <= (1 + app.config.cache_ttl) * 60
+
+
+async def test_bloom_filter_is_consulted_once_ready(faker):
+    bloom_filter = BloomFilter(AioRedisMock(), "test", 1000, 0.001, 60)
+    collection = AsyncMongoMockClient()["test"]["tinyurl"]
+    existing = [faker.pystr(min_chars=16, max_chars=16) for _ in range(100)]
+    await collection.insert_many([{"tiny_url": tiny_url} for tiny_url in existing])
+    unknown = [faker.pystr(min_chars=16, max_chars=16) for _ in range(100)]
+
+    assert all([await bloom_filter.might_contain(item) for item in unknown])
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60, batch_size=30)
+    await bloom_filter.add(["added"])
+
+    assert all([await bloom_filter.might_contain(item) for item in existing])
+    assert await bloom_filter.might_contain("added")
+    assert sum([await bloom_filter.might_contain(item) for item in unknown]) <= 2
+
+
+async def test_bloom_filter_is_rebuilt_by_one_process(faker):
+    redis = AioRedisMock()
+    bloom_filter = BloomFilter(redis, "test", 1000, 0.001, 60)
+    collection = AsyncMongoMockClient()["test"]["tinyurl"]
+    lock = redis.lock(f"{bloom_filter.key}:lock")
+    await lock.acquire(blocking=False)
+
+    assert not await bloom_filter.rebuild(collection, "tiny_url", 60)
+    assert not await redis.exists(bloom_filter.ready_key)
+
+
+async def test_bloom_filter_expires_and_picks_up_missing_links(faker):
+    redis = AioRedisMock()
+    bloom_filter = BloomFilter(redis, "test", 1000, 0.001, 60)
+    collection = AsyncMongoMockClient()["test"]["tinyurl"]
+    await collection.insert_one({"tiny_url": "existing"})
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60)
+    assert redis.store[bloom_filter.ready_key].ttl == 60
+    # Inserted by a worker which doesn't know about the filter.
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await collection.insert_one({"tiny_url": tiny_url})
+
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60)
+    assert not await bloom_filter.might_contain(tiny_url)
+    await redis.delete(bloom_filter.ready_key)
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60)
+    assert await bloom_filter.might_contain(tiny_url)
+
+
+async def test_bloom_filter_without_bitmap_is_not_ready(faker):
+    redis = AioRedisMock()
+    bloom_filter = BloomFilter(redis, "test", 1000, 0.001, 60)
+    collection = AsyncMongoMockClient()["test"]["tinyurl"]
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await collection.insert_one({"tiny_url": tiny_url})
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60)
+
+    await redis.delete(bloom_filter.key)
+
+    assert await bloom_filter.might_contain(tiny_url)
+    assert await bloom_filter.rebuild(collection, "tiny_url", 60)
+    assert await redis.exists(bloom_filter.key)
+
+
+async def test_single_flight_shares_one_call():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def load():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    results = await asyncio.gather(*(single_flight.do("key", load) for _ in range(5)))
+
+    assert results == [1] * 5
+    assert "key" not in single_flight
+    assert await single_flight.do("key", load) == 2
+
+
+async def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError()
+
+    results = await asyncio.gather(
+        *(single_flight.do("key", fail) for _ in range(3)), return_exceptions=True
+    )
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(single_flight) == 0
+
+
+async def test_concurrent_misses_load_url_once(
+    client: AsyncClient, app: TypedApp, test_url: str, monkeypatch
+):
+    url = URL(url=test_url)
+    await app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+    lookups = []
+    find_redirect = url_routes.find_redirect
+
+    async def counted_find_redirect(*args):
+        lookups.append(args)
+        await asyncio.sleep(0.01)
+        return await find_redirect(*args)
+
+    monkeypatch.setattr(url_routes, "find_redirect", counted_find_redirect)
+    responses = await asyncio.gather(
+        *(client.get(f"/url/{url.tiny_url}", follow_redirects=False) for _ in range(5))
+    )
+
+    assert all(
+        response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+        for response in responses
+    )
+    assert len(lookups) == 1
+    assert len(app.producer.queue) == 5
+
+
+async def test_concurrent_misses_consume_redirects_of_limited_url(
+    client: AsyncClient, app: TypedApp, test_url: str, monkeypatch
+):
+    url = URL(url=test_url, max_redirects=3)
+    await app.database["tinyurl"].insert_one(url.dict(by_alias=True))
+    find_redirect = url_routes.find_redirect
+
+    async def slow_find_redirect(*args):
+        await asyncio.sleep(0.01)
+        return await find_redirect(*args)
+
+    monkeypatch.setattr(url_routes, "find_redirect", slow_find_redirect)
+    responses = await asyncio.gather(
+        *(client.get(f"/url/{url.tiny_url}", follow_redirects=False) for _ in range(20))
+    )
+
+    statuses = [response.status_code for response in responses]
+    assert statuses.count(status.HTTP_307_TEMPORARY_REDIRECT) == 3
+    assert statuses.count(status.HTTP_404_NOT_FOUND) == 17
+
+
+async def test_locked_url_is_read_from_cache_filled_by_another_worker(
+    client: AsyncClient, app: TypedApp, test_url: str, faker, monkeypatch
+):
+    monkeypatch.setattr(app.config, "cache_fill_lock_seconds", 1.0)
+    monkeypatch.setattr(app.config, "cache_fill_poll_seconds", 0.01)
+    tiny_url = faker.pystr(min_chars=16, max_chars=16)
+    await app.redis.lock(f"{tiny_url}:fill").acquire(blocking=False)
+
+    async def fill():
+        await asyncio.sleep(0.05)
+        await app.redis.set(tiny_url, orjson.dumps((test_url, None, None)))
+
+    response, _ = await asyncio.gather(
+        client.get(f"/url/{tiny_url}", follow_redirects=False), fill()
+    )
+
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+    assert response.headers["location"] == test_url
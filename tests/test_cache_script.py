@@ -0,0 +1,94 @@
+import time
+
+import orjson
+import pytest
+from fakeredis import FakeStrictRedis
+
+from app.cache import MISSING, READ_AND_DECREMENT
+
+# Runs the script itself, the mock of Redis used by the other tests replaces
+# it with a Python copy. Scripts of fakeredis need the Lua runtime of lupa.
+pytest.importorskip("lupa")
+
+EXTEND_MS = 2000
+MAX_TTL_MS = 60_000
+
+
+@pytest.fixture
+def redis():
+    return FakeStrictRedis()
+
+
+@pytest.fixture
+def read_and_decrement(redis: FakeStrictRedis):
+    script = redis.register_script(READ_AND_DECREMENT)
+    return lambda key: script(keys=[key], args=[EXTEND_MS, MAX_TTL_MS])
+
+
+def test_missing_key(read_and_decrement):
+    assert read_and_decrement("key") is None
+
+
+def test_missing_link_is_returned_as_is(redis, read_and_decrement):
+    redis.set("key", MISSING, px=1000)
+
+    assert read_and_decrement("key") == MISSING
+    assert redis.pttl("key") <= 1000
+
+
+def test_unlimited_link_is_extended(redis, read_and_decrement):
+    entry = orjson.dumps(["https://example.com", None, None])
+    redis.set("key", entry, px=1000)
+
+    assert read_and_decrement("key") == entry
+    assert 1000 < redis.pttl("key") <= 1000 + EXTEND_MS
+
+
+def test_extension_is_capped(redis, read_and_decrement):
+    redis.set("key", orjson.dumps(["https://example.com", None, None]), px=MAX_TTL_MS)
+
+    read_and_decrement("key")
+
+    assert redis.pttl("key") <= MAX_TTL_MS
+
+
+def test_extension_stops_at_expiry_of_link(redis, read_and_decrement):
+    # Links are cached with whole seconds, see expiry_timestamp.
+    expires_at = int(time.time()) + 2
+    redis.set("key", orjson.dumps(["https://example.com", None, expires_at]), px=500)
+
+    read_and_decrement("key")
+
+    assert 500 < redis.pttl("key") <= 2000
+
+
+def test_limited_link_is_decremented(redis, read_and_decrement):
+    entry = orjson.dumps(["https://example.com", 2, None])
+    redis.set("key", entry, px=1000)
+
+    assert read_and_decrement("key") == entry
+    assert orjson.loads(redis.get("key")) == ["https://example.com", 1, None]
+    assert 1000 < redis.pttl("key") <= 1000 + EXTEND_MS
+
+
+def test_last_redirect_leaves_missing_link(redis, read_and_decrement):
+    entry = orjson.dumps(["https://example.com", 1, None])
+    redis.set("key", entry)
+
+    assert read_and_decrement("key") == entry
+    assert redis.get("key") == MISSING
+    assert 0 < redis.pttl("key") <= EXTEND_MS
+
+
+def test_exhausted_link_is_missing(redis, read_and_decrement):
+    redis.set("key", orjson.dumps(["https://example.com", 0, None]))
+
+    assert read_and_decrement("key") == MISSING
+    assert redis.get("key") == MISSING
+
+
+def test_expired_link_is_removed(redis, read_and_decrement):
+    redis.set("key", orjson.dumps(["https://example.com", 5, int(time.time()) - 1]))
+
+    assert read_and_decrement("key") is None
+    assert not redis.exists("key")
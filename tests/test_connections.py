@@ -0,0 +1,15 @@
+from app.config import configuration
+from app.connections import Connections
+
+
+async def test_clients_are_created_on_first_use_and_closed():
+    connections = Connections(configuration)
+    assert not connections.opened("redis")
+
+    redis = connections.redis
+    assert connections.redis is redis
+    assert not connections.opened("mongo")
+
+    await connections.close()
+    assert not connections.opened("redis")
+    assert connections.redis is not redis
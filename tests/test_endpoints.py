@@ -1,11 +1,12 @@
 import orjson
 import pytest
+from bson import ObjectId
 from fastapi import status
 from httpx import AsyncClient
 
 from app.app import TypedApp
-from app.models import URL
 from app.messaging import _default_objectid
+from app.models import URL
 from app.schemas import CreateTinyURL
 
 
@@ -90,8 +91,49 @@ async def test_bulk_create(client: AsyncClient, app: TypedApp, size: int, faker)
     assert response.status_code == status.HTTP_201_CREATED
     assert len(app.producer.queue) == size
     data = response.json()
+    assert len(data) == size
+    # One adds the URLs to the filter, the other one caches them.
+    assert app.redis.executed_pipelines == 2
+    assert all(url["tiny_url"] in app.redis.store for url in data)
     r = app.database["tinyurl"].find(
         {"tiny_url": {"$in": [d["tiny_url"] for d in data]}}, ["tiny_url", "url"]
     )
     r = await r.to_list(length=100)
     assert len(r) == len(data)
+
+
+async def test_bulk_create__partial_failure(
+    client: AsyncClient, app: TypedApp, faker, monkeypatch
+):
+    existing = URL(url=faker.url())
+    await app.database["tinyurl"].insert_one(existing.dict(by_alias=True))
+    ids = iter((existing.id, ObjectId(), existing.id))
+    monkeypatch.setattr(URL.__fields__["id"], "default_factory", lambda: next(ids))
+
+    response = await client.post(
+        "/url/bulk", json=[CreateTinyURL(url=faker.url()).dict() for _ in range(3)]
+    )
+
+    assert response.status_code == status.HTTP_207_MULTI_STATUS
+    data = response.json()
+    assert [error["index"] for error in data["errors"]] == [0, 2]
+    assert len(data["created"]) == 1
+    assert len(app.producer.queue) == 1
+    assert await app.database["tinyurl"].count_documents({}) == 2
+
+
+async def test_redirect_event_describes_stored_url(
+    client: AsyncClient, app: TypedApp, test_url_model: URL
+):
+    test_url_model.time_to_live = 24
+    await app.database["tinyurl"].insert_one(test_url_model.dict(by_alias=True))
+    response = await client.get(
+        f"/url/{test_url_model.tiny_url}", follow_redirects=False
+    )
+
+    assert response.status_code == status.HTTP_307_TEMPORARY_REDIRECT
+    topic, value = app.producer.get(decode_value=True)
+    assert topic == "URL.read"
+    assert value["id"] == str(test_url_model.id)
+    assert value["time_to_live"] == 24
+    assert value["url"] == test_url_model.url
@@ -0,0 +1,62 @@
+import pytest
+
+from app.messaging import encode_message, send_many
+from app.messaging.encoding import (
+    COMPACT_V1,
+    ENCODING_HEADER,
+    decode,
+    decode_compact,
+    encode_compact,
+)
+from app.models import URL
+from tests.fixtures.producer import MockKafkaProducer
+
+
+async def test_send_many_sends_every_message_in_order(test_url: str):
+    producer = MockKafkaProducer()
+    urls = [URL(url=test_url) for _ in range(3)]
+
+    await send_many(producer, "create", urls, additional_data={"source": "bulk"})
+
+    assert list(producer.keys) == [url.tiny_url.encode() for url in urls]
+    messages = [producer.get(decode_value=True) for _ in urls]
+    assert [topic for topic, _ in messages] == ["URL.create"] * 3
+    assert [value["tiny_url"] for _, value in messages] == [
+        url.tiny_url for url in urls
+    ]
+    assert all(value["source"] == "bulk" for _, value in messages)
+
+
+def test_compact_encoding_is_smaller_and_round_trips(test_url: str):
+    url = URL(url=test_url)
+    additional_data = {"ip_address": "::1", "user_agent": "curl/7.88.1"}
+
+    json_value, json_headers = encode_message(url, additional_data, "json")
+    compact_value, compact_headers = encode_message(url, additional_data, "compact")
+
+    assert json_headers == []
+    assert compact_headers == [(ENCODING_HEADER, COMPACT_V1)]
+    assert len(compact_value) < len(json_value) / 2
+    assert decode(compact_value, compact_headers) == {
+        "tiny_url": url.tiny_url,
+        "url": url.url,
+        **additional_data,
+    }
+    assert decode(json_value, json_headers)["tiny_url"] == url.tiny_url
+
+
+@pytest.mark.parametrize("length", (0xFFFF - 1, 0xFFFF, 0x10000))
+def test_compact_encoding_truncates_long_fields(length: int):
+    # Multibyte characters check that a field is cut between characters.
+    user_agent = "é" * (length // 2) + "a" * (length % 2)
+
+    decoded = decode_compact(encode_compact({"user_agent": user_agent}))
+
+    assert decoded["user_agent"] is not None
+    assert len(decoded["user_agent"].encode()) < 0xFFFF
+    assert user_agent.startswith(decoded["user_agent"])
+
+
+def test_unknown_encoding_is_rejected():
+    with pytest.raises(ValueError):
+        decode(b"", [(ENCODING_HEADER, b"compact/2")])